@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+
+from .profiling import record_phase
+
+logger = logging.getLogger("machma_logger")
+
+
+class AdmissionController:
+    """
+    Caps the number of concurrent assistant runs per process.
+
+    Runs beyond the cap wait in a bounded queue. When the queue is full or the estimated wait is longer
+    than the allowed maximum, the run is rejected with a 503 and a Retry-After header instead of
+    piling up until the platform timeout.
+    """
+
+    def __init__(self, max_in_flight, max_queue, max_wait_seconds, initial_run_seconds=10.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.in_flight = 0
+        self.waiting = 0
+        # Exponential moving average of the run duration, used to estimate the wait time
+        self.average_run_seconds = initial_run_seconds
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    def estimated_wait(self):
+        """
+        Returns the estimated wait in seconds for a run admitted now.
+        """
+        if self.in_flight < self.max_in_flight:
+            return 0.0
+        return math.ceil((self.waiting + 1) / self.max_in_flight) * self.average_run_seconds
+
+    def _reject(self, estimated_wait):
+        retry_after = max(1, math.ceil(estimated_wait))
+        logger.info(f"Run rejected: {self.in_flight} in flight, {self.waiting} waiting, retry after {retry_after}s")
+        raise HTTPException(
+            status_code=503,
+            detail="The chatbot is busy, please try again shortly.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def check(self):
+        """
+        Raises a 503 HTTPException if a run submitted now would not be admitted.
+        """
+        if self.in_flight < self.max_in_flight:
+            return
+        estimated_wait = self.estimated_wait()
+        if self.waiting >= self.max_queue or estimated_wait > self.max_wait_seconds:
+            self._reject(estimated_wait)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Waits for a free run slot, or raises a 503 HTTPException if the queue is full or the wait times out.
+        """
+        self.check()
+        self.waiting += 1
+        wait_started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            self._reject(self.estimated_wait())
+        finally:
+            self.waiting -= 1
+            record_phase("admission_wait", time.monotonic() - wait_started)
+
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            self.average_run_seconds = 0.8 * self.average_run_seconds + 0.2 * (time.monotonic() - started)
+
+    def stats(self):
+        """
+        Returns the current load of the controller.
+        """
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "average_run_seconds": round(self.average_run_seconds, 2),
+            "estimated_wait_seconds": round(self.estimated_wait(), 2),
+        }
+
+
+# Threads for blocking calls beyond the admitted runs (snapshot reads, shard setup)
+EXECUTOR_HEADROOM_THREADS = int(os.getenv("EXECUTOR_HEADROOM_THREADS", 8))
+
+admission = AdmissionController(
+    max_in_flight=int(os.getenv("MAX_IN_FLIGHT_RUNS", 8)),
+    max_queue=int(os.getenv("MAX_QUEUED_RUNS", 32)),
+    max_wait_seconds=float(os.getenv("MAX_QUEUE_WAIT_SECONDS", 30)),
+)
@@ -0,0 +1,22 @@
+import os
+import secrets
+from fastapi import Header, HTTPException
+from dotenv import load_dotenv
+
+# Load the .env file
+load_dotenv()
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Helper function to check an admin token, admin features are disabled when no token is configured
+def is_admin_token(token):
+    return bool(ADMIN_TOKEN) and token is not None and secrets.compare_digest(token, ADMIN_TOKEN)
+
+# Dependency to protect admin endpoints
+def verify_admin_token(x_admin_token: str = Header(None)):
+    """
+    Checks the X-Admin-Token header against the ADMIN_TOKEN environment variable.
+
+    Raises an HTTPException with status 403 if the token is missing or wrong.
+    """
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid or missing admin token.")
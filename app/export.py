@@ -0,0 +1,232 @@
+"""
+Transcript export for researchers.
+
+Turns sessions into export records (demographics, treatment, turns with timestamps) and writes
+them as NDJSON (one session per line) or CSV (one turn per row, one row for a session without turns). Pages are selected with a
+cursor over (created_at, session_id); selecting a page keeps only that page, not the sorted sessions, in memory.
+The snapshot export still loads the whole snapshot and scans it once per page.
+
+The server exposes this as GET /admin/export. The command line client pages through that
+endpoint, or reads a session snapshot file directly:
+    python -m app.export --url https://<host> --token <ADMIN_TOKEN> --format csv > transcripts.csv
+    python -m app.export --snapshot snapshots/sessions.json.gz --treatment true
+"""
+import argparse
+import base64
+import csv
+import heapq
+import io
+import json
+import sys
+from datetime import datetime, timezone
+
+# Demographic fields collected by GET /chat
+DEMOGRAPHIC_FIELDS = [
+    "gender",
+    "birth_year",
+    "school_education",
+    "vocational_education",
+    "interest_in_politics",
+    "political_concern",
+]
+CSV_FIELDS = ["session_id", "created_at", "treatment"] + DEMOGRAPHIC_FIELDS + ["turn", "role", "text", "timestamp"]
+MAX_PAGE_SIZE = 1000
+
+
+# Helper function to format a Unix timestamp as ISO 8601 in UTC
+def format_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+# Helper function to encode the position after a session as an opaque cursor
+def encode_cursor(created_at, session_id, instance_id=None):
+    return base64.urlsafe_b64encode(json.dumps([created_at, session_id, instance_id]).encode("utf-8")).decode("ascii")
+
+
+# Helper function to decode a cursor into its (created_at, session_id) position and the instance that issued it
+def decode_cursor(cursor):
+    try:
+        created_at, session_id, instance_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(created_at), str(session_id), instance_id
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+# Helper function to build the export record of a session
+def session_record(session_id, session_data):
+    """
+    Takes a session ID and the session data as input.
+
+    Interleaves bot and user messages in the order they were shown in the chat, starting with the bot.
+
+    Returns the export record of the session.
+    """
+    chat_history = session_data.get("chat_history", {"user": [], "bot": []})
+    timestamps = session_data.get("timestamps", {"user": [], "bot": []})
+    turns = []
+    for index in range(max(len(chat_history["user"]), len(chat_history["bot"]))):
+        for role in ("bot", "user"):
+            if index < len(chat_history[role]):
+                turns.append({
+                    "role": role,
+                    "text": chat_history[role][index],
+                    "timestamp": format_timestamp(timestamps[role][index]) if index < len(timestamps[role]) else None,
+                })
+    record = {
+        "session_id": session_id,
+        "created_at": format_timestamp(session_data.get("created_at")),
+        "treatment": session_data.get("treatment"),
+    }
+    record.update({field: session_data.get(field) for field in DEMOGRAPHIC_FIELDS})
+    record["turns"] = turns
+    return record
+
+
+# Main function to select a page of sessions
+def select_page(session_items, limit, cursor=None, since=None, until=None, treatment=None, instance_id=None):
+    """
+    Takes an iterable of (session ID, session data) pairs, the page size, an optional cursor,
+    optional filters on the creation time (Unix timestamps) and the treatment, and the ID of the
+    server instance whose sessions are paged as input.
+
+    Keeps at most `limit` sessions in memory besides the iterated ones. A cursor issued by another
+    instance is rejected, since that instance pages over a different set of sessions.
+
+    Returns the export records of the page and the cursor of the next page, None on the last page.
+    """
+    position = None
+    if cursor:
+        created_at, session_id, cursor_instance_id = decode_cursor(cursor)
+        if cursor_instance_id != instance_id:
+            raise ValueError("The cursor was issued by another server instance, restart the export")
+        position = (created_at, session_id)
+
+    def matching():
+        for session_id, session_data in session_items:
+            created_at = session_data.get("created_at", 0)
+            if position is not None and (created_at, session_id) <= position:
+                continue
+            if since is not None and created_at < since:
+                continue
+            if until is not None and created_at >= until:
+                continue
+            if treatment is not None and session_data.get("treatment") != treatment:
+                continue
+            yield created_at, session_id, session_data
+
+    # Take one more than the page size to know whether there is a next page
+    page = heapq.nsmallest(limit + 1, matching(), key=lambda item: (item[0], item[1]))
+    next_cursor = encode_cursor(page[limit - 1][0], page[limit - 1][1], instance_id) if len(page) > limit else None
+    return [session_record(session_id, session_data) for _, session_id, session_data in page[:limit]], next_cursor
+
+
+# Helper function to stream records as NDJSON lines
+def iter_ndjson(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+# Helper function to stream records as CSV rows, one row per turn
+def iter_csv(records, header=True):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+    if header:
+        writer.writeheader()
+    for record in records:
+        session_fields = {key: value for key, value in record.items() if key != "turns"}
+        for index, turn in enumerate(record["turns"]):
+            writer.writerow({**session_fields, "turn": index, **turn})
+        if not record["turns"]:
+            # Sessions without messages still get a row, with empty turn fields
+            writer.writerow(session_fields)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+
+# Helper function to parse a date or datetime argument into a Unix timestamp
+def parse_time(value):
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+# Main function of the command line client to export from a running server
+def export_from_server(url, token, output_format, params):
+    import requests
+
+    # A session keeps the instance affinity cookie of the load balancer, if there is one, across pages
+    http = requests.Session()
+    cursor = None
+    first_page = True
+    while True:
+        page_params = dict(params, format=output_format)
+        if cursor:
+            page_params["cursor"] = cursor
+        if output_format == "csv" and not first_page:
+            # Only the first page starts with the CSV header
+            page_params["header"] = "false"
+        with http.get(f"{url.rstrip('/')}/admin/export", params=page_params,
+                          headers={"X-Admin-Token": token}, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            response.encoding = "utf-8"
+            for chunk in response.iter_content(chunk_size=65536, decode_unicode=True):
+                sys.stdout.write(chunk)
+            cursor = response.headers.get("X-Next-Cursor")
+        first_page = False
+        if not cursor:
+            break
+
+
+# Main function of the command line client to export from a snapshot file
+def export_from_snapshot(path, output_format, page_size, since, until, treatment):
+    from .session_store import load_snapshot
+
+    session_items = load_snapshot(path).items()
+    cursor = None
+    first_page = True
+    while True:
+        records, cursor = select_page(session_items, page_size, cursor, since, until, treatment)
+        chunks = iter_csv(records, header=first_page) if output_format == "csv" else iter_ndjson(records)
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        first_page = False
+        if not cursor:
+            break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export chat transcripts as NDJSON or CSV.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--url", help="Base URL of the running server")
+    source.add_argument("--snapshot", help="Path of a session snapshot file")
+    parser.add_argument("--token", help="Admin token, required with --url")
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--since", help="Only sessions created at or after this ISO date/time (UTC if no offset)")
+    parser.add_argument("--until", help="Only sessions created before this ISO date/time (UTC if no offset)")
+    parser.add_argument("--treatment", choices=["true", "false"], help="Only sessions with this treatment")
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    if args.url:
+        if not args.token:
+            parser.error("--token is required with --url")
+        params = {"limit": args.page_size}
+        for name in ("since", "until", "treatment"):
+            if getattr(args, name):
+                params[name] = getattr(args, name)
+        export_from_server(args.url, args.token, args.format, params)
+    else:
+        export_from_snapshot(
+            args.snapshot,
+            args.format,
+            args.page_size,
+            parse_time(args.since) if args.since else None,
+            parse_time(args.until) if args.until else None,
+            None if args.treatment is None else args.treatment == "true",
+        )
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+import time
+from uuid import uuid4
+from fastapi import HTTPException
+
+from .profiling import current_profile, start_job_profile, finish_job_profile
+
+logger = logging.getLogger("machma_logger")
+
+# Finished jobs are kept this long so reconnecting clients can still collect the result
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", 600))
+# Upper bound for a single long-poll request
+MAX_POLL_SECONDS = float(os.getenv("JOB_MAX_POLL_SECONDS", 25))
+
+# In-memory job storage
+jobs = {}
+
+# Helper function to drop finished jobs past the retention window
+def prune_jobs():
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    for job_id in [job_id for job_id, job in jobs.items() if job["finished_at"] and job["finished_at"] < cutoff]:
+        del jobs[job_id]
+
+# Helper function to run a job and store its outcome
+async def run_job(job, coroutine, profile=None):
+    # The job outlives the request that submitted it, so its phases go to a linked job profile
+    current_profile.set(profile)
+    started = time.perf_counter()
+    try:
+        job["result"] = await coroutine
+        job["status"] = "completed"
+        job["status_code"] = 200
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["status_code"] = e.status_code
+        job["error"] = e.detail
+        job["headers"] = e.headers
+    except Exception as e:
+        logger.error(f"Job {job['id']} failed: {e}")
+        job["status"] = "failed"
+        job["status_code"] = 500
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = time.time()
+        job["event"].set()
+        if profile is not None:
+            finish_job_profile(profile, job["status_code"], time.perf_counter() - started)
+        logger.info(f"Job {job['id']} for session {job['session_id']} finished with status {job['status']}")
+
+# Helper function to submit a job
+def submit_job(session_id, coroutine, kind="turn", user_input=None):
+    """
+    Takes a session ID, a coroutine producing the job result, the kind of job, and the user's message
+    of a chat turn as input.
+
+    Schedules the coroutine in the background. If the submitting request is profiled, the job
+    gets its own profile, linked from the request's profile.
+
+    Returns the created job.
+    """
+    prune_jobs()
+    job = {
+        "id": str(uuid4()),
+        "session_id": session_id,
+        "kind": kind,
+        "user_input": user_input,
+        "status": "pending",
+        "result": None,
+        "status_code": None,
+        "error": None,
+        "headers": None,
+        "created_at": time.time(),
+        "finished_at": None,
+        "event": asyncio.Event(),
+    }
+    jobs[job["id"]] = job
+    profile = start_job_profile(job["id"], session_id)
+    job["task"] = asyncio.create_task(run_job(job, coroutine, profile))
+    logger.info(f"Job {job['id']} submitted for session {session_id}")
+    return job
+
+# Helper function to find the job of a session that is still running
+def get_pending_job(session_id, kind="turn"):
+    return next(
+        (job for job in jobs.values()
+         if job["session_id"] == session_id and job["kind"] == kind and job["status"] == "pending"),
+        None,
+    )
+
+# Helper function to wait for a job to finish
+async def wait_for_job(job, timeout):
+    """
+    Takes a job and the maximum wait in seconds as input.
+
+    Waits until the job is finished or the timeout has passed.
+
+    Returns the job.
+    """
+    try:
+        await asyncio.wait_for(asyncio.shield(job["event"].wait()), timeout=min(timeout, MAX_POLL_SECONDS))
+    except asyncio.TimeoutError:
+        pass
+    return job
@@ -5,24 +5,35 @@ from fastapi import (
     Depends,
     Body,
 )
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-import os
 import json
 import requests
-import openai
 from dotenv import load_dotenv
 import backoff
 from starlette.middleware.sessions import SessionMiddleware
 import logging
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
+from datetime import datetime, timezone
+from typing import Optional, Literal
 from fastapi.staticfiles import StaticFiles
 import re
+import asyncio
+import itertools
+import time
 
 # Module Docker
-from .openai_assistant import assistant_setup, create_political_conversation, create_casual_conversation, create_question_thread, chatbot_completion
+from .openai_assistant import assistant_setup, create_political_conversation, create_casual_conversation, create_question_thread, chatbot_completion, new_context_state, get_political_background, get_casual_background
 from .post_data import ChatInput
+from .session_store import load_snapshot, save_snapshot, merge_sessions, snapshot_mtime
+from .admission import admission, EXECUTOR_HEADROOM_THREADS
+from .jobs import jobs, submit_job, get_pending_job, wait_for_job
+from .shards import shards, select_shard, get_shard, remove_shards
+from .profiling import profiles, profile_request, phase, set_profile_session
+from .dependencies import verify_admin_token
+from .export import select_page, iter_ndjson, iter_csv, MAX_PAGE_SIZE
 
 import sys
 sys.path.append('/home/mo/code/deliberation_chatbot/app')
@@ -35,31 +46,56 @@ logger = logging.getLogger("machma_logger")
 
 # Load the .env file
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Initialize the Assistants Dictionary to store the assistant IDs
-assistant_dict = {}
-
-# On Startup
-# We initialize our Assistants and Vector store here
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    casual_assistant, political_assistant, question_assistant, vector_store = await assistant_setup() 
-    question_thread = await create_question_thread(question_assistant.id)
+# Helper function to set up the assistants of one shard
+async def shard_setup(shard):
+    # Initialize the Assistants Dictionary of the shard to store the assistant IDs
+    assistant_dict = shard.assistant_dict
+    casual_assistant, political_assistant, question_assistant, vector_store = await assistant_setup(shard.client) 
+    question_thread = await create_question_thread(shard.client, question_assistant.id)
     assistant_dict['casual_assistant'] = casual_assistant.id
     assistant_dict['political_assistant'] = political_assistant.id
     assistant_dict['question_assistant'] = question_assistant.id
     assistant_dict['questions_thread_id'] = question_thread.id
     assistant_dict['vector_store'] = vector_store.id
     logger.info(f"""
+                Shard {shard.id}:
                 Created Political Assistant with ID: {assistant_dict['political_assistant']}, 
                 Casual Assistant with ID: {assistant_dict['casual_assistant']}, 
                 Question Assistant with ID: {assistant_dict['question_assistant']},
                 & Vector Store with ID: {assistant_dict['vector_store']}
                 """)
+
+# On Startup
+# We initialize our Assistants and Vector store here, on every shard
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Every blocking OpenAI call runs on the default executor. Its default size depends on the CPU count and can be
+    # smaller than the admission cap, which would queue admitted runs where estimated_wait() does not see it.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+        max_workers=admission.max_in_flight + EXECUTOR_HEADROOM_THREADS, thread_name_prefix="blocking-call",
+    ))
+    # The OpenAI calls of the setup are blocking, so every shard is set up on its own thread.
+    # A shard whose setup fails (e.g. a revoked key) is dropped instead of aborting the startup.
+    results = await asyncio.gather(
+        *(asyncio.to_thread(asyncio.run, shard_setup(shard)) for shard in shards),
+        return_exceptions=True,
+    )
+    failed_shards = []
+    for shard, result in zip(list(shards), results):
+        if isinstance(result, BaseException):
+            logger.error(f"Setup of shard {shard.id} failed, the shard is not used: {result}")
+            failed_shards.append(shard)
+    remove_shards(failed_shards)
+    # Sessions from the last snapshot are moved into the live sessions on first access
+    snapshot_state["mtime"] = snapshot_mtime()
+    restored_sessions.update(load_snapshot())
     yield
     # This happens just before shutting down the server
     logger.info(f"Shutting down the server")
+    # Snapshot the sessions used on this instance, so conversations survive instance churn.
+    # Restored sessions that were never accessed are still in the snapshot and are not written back.
+    save_snapshot(sessions)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -107,8 +143,40 @@ async def about(request: Request):
 
 # Configure Session Middleware
 app.add_middleware(SessionMiddleware, secret_key="your-secret-key")
+# Profile requests on demand (X-Profile header with the admin token) or by sample rate
+app.middleware("http")(profile_request)
+# Identifies this instance in export cursors
+INSTANCE_ID = uuid4().hex[:12]
 # In-memory session storage
 sessions = {}
+# Sessions restored from the snapshot that have not been accessed on this instance yet
+restored_sessions = {}
+# Modification time of the snapshot when it was last read; the lock lets concurrent misses share one re-read
+snapshot_state = {"mtime": None}
+snapshot_lock = asyncio.Lock()
+
+# Helper function to pick up sessions that other instances wrote to the snapshot
+async def refresh_restored_sessions():
+    # Re-read the snapshot only if another instance wrote it since it was last read.
+    # The snapshot may be on a network volume, so the file access runs off the event loop.
+    async with snapshot_lock:
+        mtime = await asyncio.to_thread(snapshot_mtime)
+        if mtime is not None and mtime != snapshot_state["mtime"]:
+            snapshot_state["mtime"] = mtime
+            snapshot = await asyncio.to_thread(load_snapshot)
+            restored_sessions.update(merge_sessions(restored_sessions, snapshot))
+
+# Helper function to get a live session, restoring it from the snapshot on first access
+async def get_session(session_id):
+    if session_id not in sessions:
+        await refresh_restored_sessions()
+        if session_id not in sessions and session_id in restored_sessions:
+            sessions[session_id] = restored_sessions.pop(session_id)
+            logger.info("Session restored from snapshot: %s", session_id)
+    session_data = sessions.get(session_id)
+    if session_data is not None:
+        session_data["last_active"] = time.time()
+    return session_data
 
 # Helper function to get the session ID from the query parameters or create a new session ID
 def get_session_id(request: Request):
@@ -146,48 +214,99 @@ async def get_chat(
     - Socio-demographic and political information from the survey.
     - Political_concern: The political concern of the user to be used in the political chat session.
     
+    The thread and first message are created in the background, so the page is returned right away.
+    The page collects the first message from `/chat/jobs/{opening_job_id}`.
+
     ### Returns:
     - `TemplateResponse`: The response containing the rendered "chat.html" template.
     """
     
-    # Create a new chat session according to the treatment type
-    if not treatment:
-        thread, first_message = await create_casual_conversation(assistant_dict['casual_assistant'])
-    if treatment:
-        thread, first_message = await create_political_conversation(assistant_dict['political_assistant'], assistant_dict['vector_store'], 
-                                                        gender, 
-                                                        birth_year, 
-                                                        school_education, 
-                                                        vocational_education, 
-                                                        interest_in_politics, 
-                                                        political_concern 
-                                                        )  
-        
-    logger.info("Chat session created on thread %s", thread.id)
-    
-    # Store the chat session data
-    sessions[session_id] = {
-        "chat_history": {"user": [], "bot": [first_message]},
+    # Overloaded: render a page that reloads itself once the estimated wait has passed
+    try:
+        admission.check()
+    except HTTPException as e:
+        return templates.TemplateResponse(
+            "busy.html",
+            {"request": request, "retry_after": e.headers["Retry-After"]},
+            status_code=503,
+            headers=e.headers,
+        )
+
+    set_profile_session(session_id)
+
+    # Route the session to a shard; its thread will only be reachable with that shard's key
+    shard = select_shard(session_id)
+
+    # Store the chat session data, the thread and first message are added once the opening job is done
+    session_data = {
+        "chat_history": {"user": [], "bot": []},
         "treatment": treatment,
-        "thread_id": thread.id,
+        "thread_id": None,
+        "shard": shard.id,
         "gender": gender,
         "birth_year": birth_year,
         "school_education": school_education,
         "vocational_education": vocational_education,
         "interest_in_politics": interest_in_politics,
         "political_concern": political_concern,
+        "context": new_context_state(
+            get_political_background(gender, birth_year, school_education, vocational_education, interest_in_politics, political_concern)
+            if treatment else get_casual_background()
+        ),
+        "created_at": time.time(),
+        "last_active": time.time(),
+        # Timestamps of the messages in chat_history, for the transcript export
+        "timestamps": {"user": [], "bot": []},
         }
+    sessions[session_id] = session_data
+    restored_sessions.pop(session_id, None)
+
+    # Create the thread in the background, the page collects the first message from the job endpoint
+    job = submit_job(session_id, open_conversation(session_data, shard), kind="opening")
+    session_data["opening_job"] = job["id"]
     
     return templates.TemplateResponse(
         "chat.html",
         {
             "request": request,
-            "chat_history": sessions[session_id],
+            "chat_history": session_data,
             "session_id": session_id,
-            "first_message": first_message,
+            "first_message": None,
+            "opening_job_id": job["id"],
         },
     )
 
+# Helper function to create the thread and first message of a session
+async def open_conversation(session_data, shard):
+    """
+    Takes the session data and the shard of the session as input.
+
+    Creates the conversation thread according to the treatment type and stores the first message.
+
+    Returns the chat history.
+    """
+    assistant_dict = shard.assistant_dict
+
+    # Create a new chat session according to the treatment type
+    async with admission.slot():
+        if not session_data["treatment"]:
+            thread, first_message = await create_casual_conversation(shard.client, assistant_dict['casual_assistant'])
+        if session_data["treatment"]:
+            thread, first_message = await create_political_conversation(shard.client, assistant_dict['political_assistant'], assistant_dict['vector_store'], 
+                                                            session_data["gender"], 
+                                                            session_data["birth_year"], 
+                                                            session_data["school_education"], 
+                                                            session_data["vocational_education"], 
+                                                            session_data["interest_in_politics"], 
+                                                            session_data["political_concern"] 
+                                                            )  
+        
+    logger.info("Chat session created on thread %s of shard %s", thread.id, shard.id)
+    session_data["thread_id"] = thread.id
+    session_data["chat_history"]["bot"].append(first_message)
+    session_data["timestamps"]["bot"].append(time.time())
+    return session_data["chat_history"]
+
 # Create a chat endpoint that continues a chat session
 @backoff.on_exception(backoff.expo, Exception, max_tries=5)
 @app.post("/chat", summary="Processes user input in a political chat session")
@@ -200,9 +319,11 @@ async def post_chat(chat_input: ChatInput = Body(...)):
     - `chat_input`: A model that includes the user's input message and the session ID.
         - `user_input`: The message input by the user.
         - `session_id`: Identifier for the current chat session.
+        - `async_job`: If set, the turn runs in the background and a job ID is returned immediately.
 
     ### Returns:
-    - `JSONResponse`: Contains the updated chat history, including both user and bot messages.
+    - `JSONResponse`: Contains the updated chat history, including both user and bot messages,
+      or with `async_job` the job ID to collect the result from `/chat/jobs/{job_id}`.
 
     ### Raises:
     - `HTTPException`: In case of errors during the chatbot completion process.
@@ -215,36 +336,103 @@ async def post_chat(chat_input: ChatInput = Body(...)):
     
     user_input = chat_input.user_input
     session_id = chat_input.session_id
+    set_profile_session(session_id)
 
-    if session_id not in sessions:
+    session_data = await get_session(session_id)
+    if session_data is None:
         logger.error("Session ID not in sessions: %s", session_id)
         return JSONResponse(status_code=404, content={"message": "Session ID not found."})
 
-    session_data = sessions[session_id]
+    if chat_input.async_job:
+        # Submit the turn as a background job; a resubmitted turn that is still running is not started twice
+        job = get_pending_job(session_id)
+        if job is not None:
+            if job["user_input"] != user_input:
+                return JSONResponse(
+                    status_code=409,
+                    content={"message": "Another message of this session is still being answered.", "job_id": job["id"]},
+                )
+            return JSONResponse(status_code=202, content={"job_id": job["id"], "status": job["status"]})
+        try:
+            admission.check()
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"message": e.detail}, headers=e.headers)
+        job = submit_job(session_id, run_chat_turn(session_id, session_data, user_input), user_input=user_input)
+        return JSONResponse(status_code=202, content={"job_id": job["id"], "status": job["status"]})
+
+    try:
+        chat_history = await run_chat_turn(session_id, session_data, user_input)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"message": e.detail}, headers=e.headers)
+
+    with phase("serialize_response"):
+        return JSONResponse(content={"chat_history": chat_history})
+
+# Helper function to run one chat turn of a session
+async def run_chat_turn(session_id, session_data, user_input):
+    """
+    Takes the session ID, the session data and the user's message as input.
+
+    Starts the conversation again if its opening failed. Waits for a run slot, gets the bot response and appends both messages to the chat history.
+
+    Returns the updated chat history.
+    """
     chat_history = session_data["chat_history"]
-    
-    # Append user message
-    chat_history["user"].append(user_input)
+    timestamps = session_data.setdefault("timestamps", {"user": [], "bot": []})
+
+    # Threads only exist on the shard that created them; sessions from before sharding use the first shard
+    shard = get_shard(session_data.get("shard", shards[0].id))
+    if shard is None:
+        raise HTTPException(status_code=404, detail="The API key of this session is no longer configured.")
+    assistant_dict = shard.assistant_dict
+
+    # The first message of the session may still be generated
+    if session_data["thread_id"] is None:
+        opening_job = jobs.get(session_data.get("opening_job"))
+        if opening_job is not None and opening_job["status"] == "pending":
+            await opening_job["event"].wait()
+        if session_data["thread_id"] is None:
+            # The opening failed or its job expired, start the conversation again instead of repeating the old error
+            opening_job = get_pending_job(session_id, kind="opening") or submit_job(
+                session_id, open_conversation(session_data, shard), kind="opening")
+            session_data["opening_job"] = opening_job["id"]
+            await opening_job["event"].wait()
+            if opening_job["status"] == "failed":
+                raise HTTPException(status_code=opening_job["status_code"], detail=opening_job["error"], headers=opening_job["headers"])
+
+    # Wait for a free run slot before touching the chat history, so a rejected turn can be retried as is
+    async with admission.slot():
+        # Append user message
+        chat_history["user"].append(user_input)
+        timestamps["user"].append(time.time())
 
-    try:        
         # Determine which assistant to use based on session_data["treatment"]
         assistant_type = assistant_dict['political_assistant'] if session_data["treatment"] else assistant_dict['casual_assistant']
-        
+    
         logger.info("Message input: %s", chat_history["user"][-1])
         # Get response
-        bot_response = await chatbot_completion(
-            chat_history["user"][-1],
-            assistant_type,
-            session_data["thread_id"],
-        )
+        try:
+            bot_response = await chatbot_completion(
+                shard.client,
+                chat_history["user"][-1],
+                assistant_type,
+                session_data["thread_id"],
+                context_type="political" if session_data["treatment"] else "casual",
+                context_state=session_data["context"],
+            )
+        except Exception:
+            # Remove the user message again, so a retried turn does not show it twice
+            chat_history["user"].pop()
+            timestamps["user"].pop()
+            raise
         logger.info("Bot response: %s", bot_response)
-        
+    
         # short_response = await chatbot_completion(
         #     bot_response,
         #     assistant_dict["question_assistant"],
         #     assistant_dict["questions_thread_id"],
         # )
-        
+    
         logger.info("short response: %s", bot_response)
         # Remove all citation markings and the text in between from bot_response
         bot_response_cleaned = re.sub(r'【[^】]*】', '', bot_response)
@@ -253,11 +441,147 @@ async def post_chat(chat_input: ChatInput = Body(...)):
         if len(chat_history['bot']) == 5: 
             thank_you_message = "<p>Vielen Dank für diese spannende Unterhaltung! Sie können nun mit der Umfrage fortfahren. Wenn Sie möchten, können wir aber auch gerne noch weiter diskutieren."
             bot_response_cleaned += " " + thank_you_message
-        
+    
         # Append bot response
         chat_history["bot"].append(bot_response_cleaned)
+        timestamps["bot"].append(time.time())
 
-    except HTTPException as e:
-        return JSONResponse(status_code=e.status_code, content={"message": e.detail})
+    return chat_history
+
+# Create an endpoint that delivers the result of a chat job
+@app.get("/chat/jobs/{job_id}", summary="Long-poll the result of a chat job")
+async def get_chat_job(job_id: str, wait: float = 0):
+    """
+    Returns the result of a chat job submitted with `async_job`. Waits up to `wait` seconds
+    for the job to finish before answering. Finished jobs are kept for the retention window,
+    so clients that lost their connection can collect the answer without triggering a new run.
+
+    ### Parameters:
+    - `job_id`: The ID returned when the job was submitted.
+    - `wait`: Maximum number of seconds to wait for the job to finish.
+
+    ### Returns:
+    - `JSONResponse`: 202 while the job is pending, the chat history once it is completed,
+      or the error status and message if it failed.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"message": "Job ID not found."})
+    set_profile_session(job["session_id"])
+    if wait > 0:
+        await wait_for_job(job, wait)
+
+    if job["status"] == "pending":
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": job["status"]})
+    if job["status"] == "failed":
+        return JSONResponse(
+            status_code=job["status_code"],
+            content={"job_id": job_id, "status": job["status"], "message": job["error"]},
+            headers=job["headers"],
+        )
+    # The chat page collects every answer here, so this is where a large chat history is serialized
+    with phase("serialize_response"):
+        return JSONResponse(content={"job_id": job_id, "status": job["status"], "chat_history": job["result"]})
+
+# Create an admin endpoint that reports the load of this instance
+@app.get("/admin/status", summary="Report the load of this instance", dependencies=[Depends(verify_admin_token)])
+async def get_status():
+    """
+    Reports the admission control state of this instance, to tune `MAX_IN_FLIGHT_RUNS`,
+    `MAX_QUEUED_RUNS` and `MAX_QUEUE_WAIT_SECONDS`, and the state of every API key shard.
+
+    ### Returns:
+    - `JSONResponse`: Runs in flight and waiting, the average run time and the estimated wait for a new run,
+      and per shard whether it is healthy, its remaining throttle time and how often it was throttled.
+    """
+    return JSONResponse(content={
+        "admission": admission.stats(),
+        "shards": [shard.stats() for shard in shards],
+    })
+
+# Create an admin endpoint that lists the recorded request profiles
+@app.get("/admin/profiles", summary="List the recorded request profiles", dependencies=[Depends(verify_admin_token)])
+async def list_profiles():
+    """
+    Lists the last recorded request profiles, newest first, without the profiler output.
+    Requests are profiled when they carry the `X-Profile` header with the admin token,
+    or when they are sampled according to `PROFILE_SAMPLE_RATE`.
+
+    ### Returns:
+    - `JSONResponse`: Method, path, session ID, status code, duration and phase timings per profile.
+    """
+    return JSONResponse(content={
+        "profiles": [
+            {key: value for key, value in profile.items() if key != "profile"}
+            for profile in reversed(profiles)
+        ],
+    })
+
+# Create an admin endpoint that returns a single request profile
+@app.get("/admin/profiles/{profile_id}", summary="Get a recorded request profile", dependencies=[Depends(verify_admin_token)])
+async def get_profile(profile_id: str):
+    """
+    Returns a recorded request profile including the async-aware profiler output, if pyinstrument is installed.
+
+    ### Parameters:
+    - `profile_id`: The ID of the profile from `/admin/profiles`.
+
+    ### Returns:
+    - `JSONResponse`: The profile, or 404 if it is no longer kept.
+    """
+    profile = next((profile for profile in profiles if profile["id"] == profile_id), None)
+    if profile is None:
+        return JSONResponse(status_code=404, content={"message": "Profile ID not found."})
+    return JSONResponse(content=profile)
+
+# Create an admin endpoint that exports the chat transcripts
+@app.get("/admin/export", summary="Export chat transcripts as NDJSON or CSV", dependencies=[Depends(verify_admin_token)])
+async def export_transcripts(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    limit: int = 500,
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    treatment: Optional[bool] = None,
+    header: bool = True,):
+    """
+    Streams one page of sessions with demographics, treatment, and turns with timestamps, ordered by creation time.
+    Covers the live sessions of this instance and every session in the current snapshot. Live sessions of
+    other instances are missing until they are in the snapshot. The cursor is bound to this instance, so a
+    page requested from another instance is rejected instead of mixing the session sets of two instances.
+
+    ### Parameters:
+    - `format`: `ndjson` for one session per line, `csv` for one turn per row.
+    - `limit`: Number of sessions per page, at most 1000.
+    - `cursor`: The `X-Next-Cursor` header of the previous page.
+    - `since`, `until`: Only sessions created in this time range (ISO 8601, UTC if no offset).
+    - `treatment`: Only sessions with this treatment.
+    - `header`: Whether a CSV page starts with the header row.
+
+    ### Returns:
+    - `StreamingResponse`: The page, with the cursor of the next page in the `X-Next-Cursor` header if there is one.
+    """
+    def to_timestamp(value):
+        if value is None:
+            return None
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+
+    await refresh_restored_sessions()
+    # select_page does not await, so the dictionaries cannot change while they are iterated
+    session_items = itertools.chain(
+        sessions.items(),
+        ((session_id, session_data) for session_id, session_data in restored_sessions.items() if session_id not in sessions),
+    )
+
+    try:
+        records, next_cursor = select_page(
+            session_items, max(1, min(limit, MAX_PAGE_SIZE)), cursor, to_timestamp(since), to_timestamp(until), treatment,
+            instance_id=INSTANCE_ID,
+        )
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
 
-    return JSONResponse(content={"chat_history": chat_history})
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    if format == "csv":
+        return StreamingResponse(iter_csv(records, header=header), media_type="text/csv", headers=headers)
+    return StreamingResponse(iter_ndjson(records), media_type="application/x-ndjson", headers=headers)
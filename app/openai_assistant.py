@@ -1,5 +1,8 @@
 import asyncio
-from openai import OpenAI
+import hashlib
+import itertools
+import math
+from openai import RateLimitError
 import backoff
 from dotenv import load_dotenv
 import os
@@ -14,9 +17,43 @@ import logging
 setup_logging()
 logger = logging.getLogger("machma_logger")
 
+from .shards import report_throttled
+from .profiling import phase
+
 # Load the .env file
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Context management settings per assistant type
+# Every run re-sends the thread, so long conversations get slower and more expensive with every turn.
+# The run is capped to the last N messages and a token budget; older turns are folded into a rolling summary.
+CONTEXT_SETTINGS = {
+    "political": {
+        "max_prompt_tokens": int(os.getenv("POLITICAL_MAX_PROMPT_TOKENS", 20000)),
+        "max_completion_tokens": int(os.getenv("POLITICAL_MAX_COMPLETION_TOKENS", 1000)),
+        "last_messages": int(os.getenv("POLITICAL_LAST_MESSAGES", 12)),
+        "summarize": os.getenv("POLITICAL_SUMMARIZE", "true").lower() == "true",
+    },
+    "casual": {
+        "max_prompt_tokens": int(os.getenv("CASUAL_MAX_PROMPT_TOKENS", 8000)),
+        "max_completion_tokens": int(os.getenv("CASUAL_MAX_COMPLETION_TOKENS", 800)),
+        "last_messages": int(os.getenv("CASUAL_LAST_MESSAGES", 10)),
+        "summarize": os.getenv("CASUAL_SUMMARIZE", "true").lower() == "true",
+    },
+}
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+
+# The normalized corpus written by app/preprocess_corpus.py is uploaded instead of the raw PDFs when it exists.
+# Its vector store name contains a hash of the corpus manifest, so a regenerated corpus is uploaded to a new store
+# and deployments with an older store switch over automatically.
+PDF_DIRECTORY = 'app/data'
+CORPUS_DIRECTORY = 'app/data/corpus'
+CORPUS_MANIFEST = os.path.join(CORPUS_DIRECTORY, 'manifest.json')
+if os.path.isfile(CORPUS_MANIFEST):
+    with open(CORPUS_MANIFEST, 'rb') as manifest_file:
+        corpus_version = hashlib.sha256(manifest_file.read()).hexdigest()[:8]
+    VECTOR_STORE_NAME, VECTOR_STORE_DIRECTORY, VECTOR_STORE_EXTENSION = f"Party Programs (normalized {corpus_version})", CORPUS_DIRECTORY, '.md'
+else:
+    VECTOR_STORE_NAME, VECTOR_STORE_DIRECTORY, VECTOR_STORE_EXTENSION = "Party Programs", PDF_DIRECTORY, '.pdf'
 
 # Helper function to create a political conversation
 def get_political_conversation(gender, birth_year, school_education, vocational_education, interest_in_politics, political_concern):
@@ -79,6 +116,39 @@ def get_casual_conversation():
         }]
     return conversation_start
 
+# Helper function to create the background of a political conversation that stays pinned once the start is truncated
+def get_political_background(gender, birth_year, school_education, vocational_education, interest_in_politics, political_concern):
+    """
+    Takes sociodemographic data and political concern as input.
+
+    Unlike the conversation starter, contains no one-time steps such as the introduction.
+
+    Returns the background for the political assistant.
+    """
+    return f"""
+    You have already introduced yourself at the start of this conversation. Do not introduce yourself again.
+    Your discussion partner self identifies as
+    Gender: {gender}
+    Born in: {birth_year}
+    Their highest level of general school education ist: {school_education}
+    Their highest level of vocational training is: {vocational_education}
+    Their interest in politics is: {interest_in_politics}
+    Their main political concern is: {political_concern}
+    Use this information to tailor your conversation style and arguments, but do not mention these characteristics explicitly.
+    Be concise. Limit yourself to one question or statement at a time.
+    """
+
+# Helper function to create the background of a casual conversation that stays pinned once the start is truncated
+def get_casual_background():
+    """
+    Returns the background for the casual assistant.
+    """
+    return """
+    You have already introduced yourself at the start of this conversation. Do not introduce yourself again.
+    Speak in German using a clear language adapted to your discussion partner, gracefully avoid and redirect any political issue.
+    Keep your messages moderately concise.
+    """
+
 # Helper function to create a question conversation
 def get_question_conversation():
     """
@@ -122,11 +192,37 @@ def get_question_conversation():
     return conversation_start
 
 
+# Helper function to drain the shard of a client that hit its rate limit
+def raise_throttled(client, error):
+    """
+    Takes the OpenAI client and the rate limit error as input.
+
+    Marks the shard of the client as throttled, so no new sessions are routed to it.
+
+    Raises an HTTPException with status 503 and a Retry-After header set to the remaining throttle time
+    of the shard, which the chat page waits for before retrying.
+    """
+    retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+    try:
+        retry_after = float(retry_after) if retry_after else None
+    except ValueError:
+        retry_after = None
+    throttled_for = report_throttled(client, retry_after)
+    raise HTTPException(
+        status_code=503,
+        detail=f"Rate limit reached: {str(error)}",
+        headers={"Retry-After": str(max(1, math.ceil(throttled_for)))},
+    )
+
+# Helper function to stop retrying once the shard is throttled, the client retries after the Retry-After instead
+def is_throttled_error(error):
+    return isinstance(error, HTTPException) and error.status_code == 503
+
 # Helper function to create an assistant, if not found
 @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def create_assistant(type):
+async def create_assistant(client, type):
     """
-    Takes a boolean flag to determine the type of assistant to create.
+    Takes the OpenAI client of the shard and a flag to determine the type of assistant to create.
     
     Creates a new assistant based on the provided type.
     
@@ -190,7 +286,7 @@ async def create_assistant(type):
 # Helper function to get an assistant, returns the ID of the Political Analyst Assistant if found 
 # Creates a new Political Assistant if not found
 @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def get_political_assistant():
+async def get_political_assistant(client):
     """
     Checks if a political assistant exists, and returns it if found.
     If not, creates a new political assistant.
@@ -208,11 +304,11 @@ async def get_political_assistant():
                     return assistant
             # If no assistant found in the loop, create a new one
             logger.info("No Political Assistant found in the list of assistants, creating a new one...")
-            assistant = await create_assistant(type="political")
+            assistant = await create_assistant(client, type="political")
             return assistant
         else:
             logger.info("No assistants available or failed to fetch data, creating a new assistant...")
-            assistant = await create_assistant(type="political")
+            assistant = await create_assistant(client, type="political")
             return assistant
     except Exception as e:
         logger.info("Failed to fetch assistants:", e)
@@ -220,7 +316,7 @@ async def get_political_assistant():
     
 # Helper function to get an assistant, returns the ID of the Casual Assistant if found
 @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def get_casual_assistant():
+async def get_casual_assistant(client):
     """
     Checks if a casual assistant exists, and returns it if found.
     If not, creates a new casual assistant.
@@ -238,11 +334,11 @@ async def get_casual_assistant():
                     return assistant
             # If no assistant found in the loop, create a new one
             logger.info("No Casual Assistant found in the list of assistants, creating a new one...")
-            assistant = await create_assistant(type="casual")
+            assistant = await create_assistant(client, type="casual")
             return assistant
         else:
             logger.info("No assistants available or failed to fetch data, creating a new assistant...")
-            assistant = await create_assistant(type="casual")
+            assistant = await create_assistant(client, type="casual")
             return assistant
     except Exception as e:
         logger.info("Failed to fetch assistants:", e)
@@ -250,7 +346,7 @@ async def get_casual_assistant():
     
 # Helper function to get an assistant, returns the ID of the Question Assistant if found
 @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def get_question_assistant():
+async def get_question_assistant(client):
     """
     Checks if a question assistant exists, and returns it if found.
     If not, creates a new question assistant.
@@ -268,11 +364,11 @@ async def get_question_assistant():
                     return assistant
             # If no assistant found in the loop, create a new one
             logger.info("No Question Assistant found in the list of assistants, creating a new one...")
-            assistant = await create_assistant(type="question")
+            assistant = await create_assistant(client, type="question")
             return assistant
         else:
             logger.info("No assistants available or failed to fetch data, creating a new assistant...")
-            assistant = await create_assistant(type="question")
+            assistant = await create_assistant(client, type="question")
             return assistant
     except Exception as e:
         logger.info("Failed to fetch assistants:", e)
@@ -280,9 +376,9 @@ async def get_question_assistant():
 
 # Helper function to ensure the vector store is attached to the assistant
 @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def ensure_vector_store(assistant):
+async def ensure_vector_store(client, assistant):
     """
-    Takes an assistant and ensures that the correct vector store is attached to it.
+    Takes the OpenAI client of the shard and an assistant and ensures that the correct vector store is attached to it.
     
     Returns the vector store.     
     """
@@ -293,7 +389,7 @@ async def ensure_vector_store(assistant):
         if vector_store_ids:
             # Fetch the vector store details
             vector_store = client.beta.vector_stores.retrieve(vector_store_id=vector_store_ids[0])
-            if vector_store and vector_store.name == "Party Programs":
+            if vector_store and vector_store.name == VECTOR_STORE_NAME:
                 logger.info(f"Correct vector store already attached with ID: {vector_store.id}")
                 return vector_store
             else:
@@ -303,23 +399,23 @@ async def ensure_vector_store(assistant):
 
         # If the correct vector store is not attached, check if such a store exists
         all_stores = client.beta.vector_stores.list()
-        party_programs_store = next((store for store in all_stores.data if store.name == "Party Programs"), None)
+        party_programs_store = next((store for store in all_stores.data if store.name == VECTOR_STORE_NAME), None)
         
         if party_programs_store:
             vector_store = party_programs_store
-            logger.info(f"Vector store 'Party Programs' found with ID: {vector_store.id}")
+            logger.info(f"Vector store '{VECTOR_STORE_NAME}' found with ID: {vector_store.id}")
         else:
             # Create a new vector store if not found
-            logger.info("Creating new vector store 'Party Programs'")
-            vector_store = client.beta.vector_stores.create(name="Party Programs")
+            logger.info(f"Creating new vector store '{VECTOR_STORE_NAME}'")
+            vector_store = client.beta.vector_stores.create(name=VECTOR_STORE_NAME)
 
             # Upload files to the vector store
-            directory = 'app/data'
+            directory = VECTOR_STORE_DIRECTORY
             if not os.path.exists(directory):
                 raise FileNotFoundError(f"Directory {directory} does not exist")
-            file_paths = [os.path.join(directory, filename) for filename in os.listdir(directory) if filename.endswith('.pdf')]
+            file_paths = [os.path.join(directory, filename) for filename in os.listdir(directory) if filename.endswith(VECTOR_STORE_EXTENSION)]
             if not file_paths:
-                raise FileNotFoundError(f"No PDF files found in directory {directory}")
+                raise FileNotFoundError(f"No {VECTOR_STORE_EXTENSION} files found in directory {directory}")
             
             # Open file streams
             file_streams = [open(path, "rb") for path in file_paths]
@@ -349,8 +445,8 @@ async def ensure_vector_store(assistant):
         raise HTTPException(status_code=500, detail=f"Failed to ensure vector store: {str(e)}")
     
 # Helper Function to create a new political conversation thread
-@backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def create_political_conversation(assistant, vector_store, gender, 
+@backoff.on_exception(backoff.expo, Exception, max_tries=5, giveup=is_throttled_error)
+async def create_political_conversation(client, assistant, vector_store, gender, 
                                                       birth_year, 
                                                       school_education, 
                                                       vocational_education, 
@@ -358,7 +454,7 @@ async def create_political_conversation(assistant, vector_store, gender,
                                                       political_concern 
                                                       ):
     """
-    Takes assistant, vector store, and sociodemographic data as input.
+    Takes the OpenAI client of the shard, assistant, vector store, and sociodemographic data as input.
     
     Creates a new political conversation thread with the provided data.
     
@@ -366,7 +462,8 @@ async def create_political_conversation(assistant, vector_store, gender,
     """
     try:
         # Create a new conversation thread
-        thread = client.beta.threads.create(
+        thread = await asyncio.to_thread(
+                            client.beta.threads.create,
                             messages=get_political_conversation(gender, 
                                                       birth_year, 
                                                       school_education, 
@@ -383,13 +480,15 @@ async def create_political_conversation(assistant, vector_store, gender,
         logger.info(f"Political conversation thread created with ID: {thread.id}")
         
         # Create and poll the run
-        run = client.beta.threads.runs.create_and_poll(
+        run = await asyncio.to_thread(
+            client.beta.threads.runs.create_and_poll,
             thread_id=thread.id, assistant_id=assistant
         )
         logger.debug(f"Political conversation run created with ID: {run.id}")
         if run.status == 'completed': 
             logger.debug("Run status is completed") 
-            response = client.beta.threads.messages.list(
+            response = await asyncio.to_thread(
+                client.beta.threads.messages.list,
                 thread_id=thread.id)
         else:
             logger.info(f"Run status is not completed: {run.status}")
@@ -399,15 +498,17 @@ async def create_political_conversation(assistant, vector_store, gender,
         first_message = response.data[0].content[0].text.value
         logger.debug("first_message: %s", first_message)
         return thread, first_message
+    except RateLimitError as e:
+        raise_throttled(client, e)
     except Exception as e:
         logger.error("Failed to create political conversation:", e)
         raise HTTPException(status_code=500, detail=f"Failed to create political conversation: {str(e)}")
     
 # Helper Function to create a new casual conversation thread
-@backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def create_casual_conversation(assistant):
+@backoff.on_exception(backoff.expo, Exception, max_tries=5, giveup=is_throttled_error)
+async def create_casual_conversation(client, assistant):
     """
-    Takes assistant as input.
+    Takes the OpenAI client of the shard and assistant as input.
     
     Creates a new casual conversation thread.
     
@@ -416,19 +517,22 @@ async def create_casual_conversation(assistant):
     
     try:
         # Create a new conversation thread
-        thread = client.beta.threads.create(
+        thread = await asyncio.to_thread(
+                            client.beta.threads.create,
                             messages=get_casual_conversation(),
                             )
         logger.info(f"Casual conversation thread created with ID: {thread.id}")
         
         # Create and poll the run
-        run = client.beta.threads.runs.create_and_poll(
+        run = await asyncio.to_thread(
+            client.beta.threads.runs.create_and_poll,
             thread_id=thread.id, assistant_id=assistant
         )
         logger.debug(f"Casual conversation run created with ID: {run.id}")
         if run.status == 'completed': 
             logger.debug("Run status is completed") 
-            response = client.beta.threads.messages.list(
+            response = await asyncio.to_thread(
+                client.beta.threads.messages.list,
                 thread_id=thread.id)
         else:
             logger.info(f"Run status is not completed: {run.status}")
@@ -438,15 +542,17 @@ async def create_casual_conversation(assistant):
         first_message = response.data[0].content[0].text.value
         logger.debug("first_message: %s", first_message)
         return thread, first_message
+    except RateLimitError as e:
+        raise_throttled(client, e)
     except Exception as e:
         logger.error("Failed to create casual conversation:", e)
         raise HTTPException(status_code=500, detail=f"Failed to create casual conversation: {str(e)}")
     
 # Helper Function to create a new question conversation thread
 @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def create_question_thread(assistant):
+async def create_question_thread(client, assistant):
     """
-    Takes assistant as input.
+    Takes the OpenAI client of the shard and assistant as input.
     
     Creates a new question conversation thread.
     
@@ -462,7 +568,8 @@ async def create_question_thread(assistant):
         logger.debug("Question thread created with ID: %s", thread.id)
         logger.debug("Question Assistant ID: %s", assistant)
         # Create and poll the run
-        run = client.beta.threads.runs.create_and_poll(
+        run = await asyncio.to_thread(
+            client.beta.threads.runs.create_and_poll,
             thread_id=thread.id, assistant_id=assistant
         )
         logger.debug("run created with id: %s", run.id)
@@ -475,22 +582,24 @@ async def create_question_thread(assistant):
     
 # Main function to run the setup
 @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-async def assistant_setup():
+async def assistant_setup(client):
     """
-    Main function to set up the assistants and vector store.
+    Takes the OpenAI client of a shard as input.
+
+    Main function to set up the assistants and vector store of the shard.
     """
     try:
         # Step 1: Get or create the casual assistant
-        casual_assistant = await get_casual_assistant()
+        casual_assistant = await get_casual_assistant(client)
         
         # Step 2: Get or create the political assistant
-        political_assistant = await get_political_assistant()
+        political_assistant = await get_political_assistant(client)
         
         # Step 3: Get or create the question assistant
-        question_assistant = await get_question_assistant()
+        question_assistant = await get_question_assistant(client)
 
         # Step 4: Ensure the assistant has the correct vector store attached
-        vector_store = await ensure_vector_store(political_assistant)
+        vector_store = await ensure_vector_store(client, political_assistant)
         
         return casual_assistant, political_assistant, question_assistant, vector_store
 
@@ -498,37 +607,183 @@ async def assistant_setup():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Helper function to create an empty context state for a new session
+def new_context_state(background=None):
+    """
+    Takes the background of the conversation to pin once the conversation starter is truncated as input.
+
+    Returns the per-session context state used by chatbot_completion.
+
+    The state is stored alongside the session and keeps the pinned background, the rolling summary,
+    the user message posted by an unfinished turn, and the context metrics.
+    """
+    return {
+        "pinned_instructions": background,
+        "summary": "",
+        # The conversation starter (message 0) is replaced by the pinned background instead of being summarized
+        "summarized_messages": 1,
+        "pending_message": None,
+        "metrics": {
+            "turns": 0,
+            "thread_messages": 0,
+            "truncated_messages": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "last_prompt_tokens": 0,
+        },
+    }
+
+# Helper function to fold messages that dropped out of the truncation window into the rolling summary
+async def update_rolling_summary(client, thread, context_state, last_messages):
+    """
+    Takes the OpenAI client of the shard, thread ID, the session context state, and the truncation window as input.
+
+    Once messages have dropped out of the last N messages without being summarized, summarizes them together
+    with the next N/2 messages, so the extra upstream call only happens every few turns.
+    A failed summary is logged and the previous summary is kept; it never fails the turn.
+
+    Returns the updated summary.
+    """
+    thread_messages = context_state["metrics"]["thread_messages"]
+    summarized_messages = max(context_state["summarized_messages"], 1)
+    window_start = thread_messages - last_messages
+    if window_start <= summarized_messages:
+        return context_state["summary"]
+    # Summarize ahead into the window, but never the message of the current turn
+    summary_end = min(window_start + max(last_messages // 2, 1), thread_messages - 1)
+
+    def list_new_messages():
+        # Messages are listed oldest first; the paginator only fetches pages up to the end of the batch
+        response = client.beta.threads.messages.list(thread_id=thread, order="asc")
+        return list(itertools.islice(response, summarized_messages, summary_end))
+
+    try:
+        new_messages = await asyncio.to_thread(list_new_messages)
+        if not new_messages:
+            return context_state["summary"]
+        transcript = "\n".join(
+            f"{message.role}: {message.content[0].text.value}" for message in new_messages if message.content
+        )
+        completion = await asyncio.to_thread(
+            client.chat.completions.create,
+            model=SUMMARY_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Summarize the conversation so far in a few sentences. Keep the discussion partner's "
+                               "stated views, concerns and the topics already covered. Write in the language of the conversation.",
+                },
+                {
+                    "role": "user",
+                    "content": f"Previous summary:\n{context_state['summary']}\n\nNew messages:\n{transcript}",
+                },
+            ],
+        )
+        context_state["summary"] = completion.choices[0].message.content
+        context_state["summarized_messages"] = summary_end
+        logger.info(f"Rolling summary updated for thread {thread}, covering {summary_end} messages")
+    except Exception as e:
+        logger.error(f"Failed to update rolling summary, keeping the previous summary: {e}")
+    return context_state["summary"]
+
 # Main Chatbot Completion Function for assistants API
-@backoff.on_exception(backoff.expo, Exception, max_tries=5)
+@backoff.on_exception(backoff.expo, Exception, max_tries=5, giveup=is_throttled_error)
 async def chatbot_completion(
+    client,
     user_message,
     assistant,
     thread,
+    context_type=None,
+    context_state=None,
     ):
     """
-    Takes user message, assistant ID, and thread ID as input.
+    Takes the OpenAI client of the shard, user message, assistant ID, and thread ID as input.
+    Optionally takes the assistant type ("political" or "casual") and the session context state
+    to bound the context sent with the run.
     
-    Gets chatbot answer based on the provided input.
+    Gets chatbot answer based on the provided input. With a context state, a retried turn does not
+    post the same user message to the thread again.
     
     Returns the bot response.
     """
     logger.debug(user_message)
     logger.debug(assistant)
     logger.debug(thread)
+    settings = CONTEXT_SETTINGS.get(context_type)
+    run_options = {}
+    if settings:
+        if context_state is None:
+            context_state = new_context_state()
+        metrics = context_state["metrics"]
+        run_options = {
+            "max_prompt_tokens": settings["max_prompt_tokens"],
+            "max_completion_tokens": settings["max_completion_tokens"],
+            "truncation_strategy": {"type": "last_messages", "last_messages": settings["last_messages"]},
+        }
     try:
-        # Create a message to append to our thread
-        bot_message = client.beta.threads.messages.create(
-            thread_id=thread, role='user', content=user_message)
-        logger.info(f"Bot message received: {bot_message}")
+        pending_message = context_state.get("pending_message") if context_state is not None else None
+        if pending_message and pending_message["text"] == user_message:
+            # A previous attempt of this turn already posted the message
+            logger.info(f"Reusing message {pending_message['id']} posted by a previous attempt")
+        else:
+            # Create a message to append to our thread
+            with phase("upstream_message_create"):
+                bot_message = await asyncio.to_thread(
+                    client.beta.threads.messages.create,
+                    thread_id=thread, role='user', content=user_message)
+            logger.info(f"Bot message received: {bot_message}")
+            if context_state is not None:
+                context_state["pending_message"] = {"id": bot_message.id, "text": user_message}
+            if settings:
+                # The thread holds the conversation starter, the first bot message and all turns so far, plus this message
+                metrics["thread_messages"] = max(metrics["thread_messages"], 2) + 1
+                metrics["truncated_messages"] = max(metrics["thread_messages"] - settings["last_messages"], 0)
+        if settings and metrics["truncated_messages"]:
+            # The conversation starter carries the participant's data; keep its background once it is truncated
+            instructions = []
+            if context_state.get("pinned_instructions"):
+                instructions.append(f"Background of this conversation:\n{context_state['pinned_instructions']}")
+            if settings["summarize"]:
+                with phase("rolling_summary"):
+                    summary = await update_rolling_summary(client, thread, context_state, settings["last_messages"])
+                if summary:
+                    instructions.append(f"Summary of the earlier conversation, which is no longer shown to you:\n{summary}")
+            if instructions:
+                run_options["additional_instructions"] = "\n\n".join(instructions)
         # Execute our run
-        run = client.beta.threads.runs.create_and_poll(
-            thread_id=thread,
-            assistant_id=assistant,
-        )
-        response = client.beta.threads.messages.list(thread_id=thread, run_id=run.id)
-        return response.data[0].content[0].text.value
+        with phase("upstream_run"):
+            run = await asyncio.to_thread(
+                client.beta.threads.runs.create_and_poll,
+                thread_id=thread,
+                assistant_id=assistant,
+                **run_options,
+            )
+        if settings and run.usage:
+            metrics["prompt_tokens"] += run.usage.prompt_tokens
+            metrics["completion_tokens"] += run.usage.completion_tokens
+            metrics["last_prompt_tokens"] = run.usage.prompt_tokens
+        if run.status not in ('completed', 'incomplete'):
+            raise HTTPException(status_code=500, detail=f"Run ended with status {run.status}: {run.last_error}")
+
+        with phase("upstream_messages_list"):
+            response = await asyncio.to_thread(client.beta.threads.messages.list, thread_id=thread, run_id=run.id)
+        texts = [message.content[0].text.value for message in response.data if message.content]
+        if run.status == 'incomplete':
+            # Token limit reached: use the partial answer if there is one
+            logger.info(f"Run incomplete: {run.incomplete_details}")
+            if not texts:
+                raise HTTPException(status_code=500, detail=f"Run incomplete without an answer: {run.incomplete_details}")
+        if context_state is not None:
+            context_state["pending_message"] = None
+        if settings:
+            metrics["thread_messages"] += 1
+            metrics["turns"] += 1
+            logger.info(f"Context metrics for thread {thread}: {metrics}")
+        return texts[0]
+    except RateLimitError as e:
+        raise_throttled(client, e)
+    except HTTPException:
+        raise
     except Exception as e:
         error_message = f"Error occurred in chatbot_completion: {str(e)}"
         raise HTTPException(status_code=500, detail=error_message)
-    
-    
\ No newline at end of file
@@ -2,4 +2,5 @@ from pydantic import BaseModel
 
 class ChatInput(BaseModel):
     user_input: str
-    session_id: str
\ No newline at end of file
+    session_id: str
+    async_job: bool = False
\ No newline at end of file
@@ -0,0 +1,276 @@
+"""
+Offline preprocessing of the party programs for the file_search vector store.
+
+Extracts the text of every PDF in app/data, removes layout noise (running headers, footers,
+page numbers, table of contents entries, hyphenation), drops repeated sentences and duplicate
+passages, and writes one compact Markdown file per party to app/data/corpus. Every chunk starts
+with a short [party – section] tag, so the chunks file_search cuts from the upload carry their
+source. ensure_vector_store uploads this corpus when it exists.
+
+Run from the repository root:
+    python -m app.preprocess_corpus [--input app/data] [--output app/data/corpus] [--workers N]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pypdf import PdfReader
+
+# pypdf warns about every font it cannot fully parse, which is irrelevant for text extraction
+logging.getLogger("pypdf").setLevel(logging.ERROR)
+
+INPUT_DIRECTORY = 'app/data'
+CORPUS_DIRECTORY = 'app/data/corpus'
+# Target size of a chunk in characters; chunks are split at sentence boundaries
+CHUNK_CHARS = 1500
+# A line that appears on at least this share of pages is treated as a running header or footer
+BOILERPLATE_PAGE_SHARE = 0.3
+# Shorter lines are never treated as boilerplate, some layouts put single words on their own line
+BOILERPLATE_MIN_CHARS = 12
+# Sentences at least this long are only kept once per document, layouts repeat them as pull quotes
+REPEATED_SENTENCE_MIN_CHARS = 40
+# All-caps lines need this many letters and words to count as a heading, so acronyms (IPCC, ÖPNV) do not
+CAPS_HEADING_MIN_LETTERS = 8
+CAPS_HEADING_MIN_WORDS = 2
+
+# Documents in app/data that are not party programs
+SOURCE_NAMES = {
+    "Powers_of_EU_Parliament": "Befugnisse des Europäischen Parlaments",
+}
+
+HEADING_PATTERN = re.compile(r'^(?:(?:\d+(?:\.\d+)*|[IVXLC]+)\.?|Kapitel \d+:?)\s+\S.*$')
+PAGE_NUMBER_PATTERN = re.compile(r'^(?:Seite\s*)?\d+(?:\s*/\s*\d+)?$', re.IGNORECASE)
+# Table of contents entry: dot leaders, optionally followed by a page number
+TOC_ENTRY_PATTERN = re.compile(r'(?:\.\s*){4,}\d*$|…\s*\d+$')
+# Line ending in a page number; a page consisting mostly of these is a table of contents without dot leaders
+PAGE_REFERENCE_PATTERN = re.compile(r'\D\s\d{1,3}$')
+# Share of lines ending in a page number from which a page is treated as a table of contents
+TOC_PAGE_SHARE = 0.5
+SENTENCE_END_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+
+# Helper function to get the display name of a document
+def source_name(stem):
+    return SOURCE_NAMES.get(stem, stem.replace('_', ' '))
+
+
+# Helper function to normalize a line for boilerplate detection
+def line_signature(line):
+    return re.sub(r'\d+', '#', re.sub(r'\s+', ' ', line)).strip().lower()
+
+
+# Helper function to check whether a line is a section heading
+def is_heading(line):
+    if len(line) > 90 or line.endswith(('.', ',', ';', '-')):
+        return False
+    if HEADING_PATTERN.match(line):
+        return True
+    letters = [char for char in line if char.isalpha()]
+    return (
+        len(letters) >= CAPS_HEADING_MIN_LETTERS
+        and len(line.split()) >= CAPS_HEADING_MIN_WORDS
+        and all(char.isupper() for char in letters)
+    )
+
+
+# Helper function to remove running headers, footers and page numbers
+def strip_boilerplate(pages):
+    """
+    Takes a list of pages, each a list of lines, as input.
+
+    Removes page numbers, table of contents entries and lines that repeat on many pages.
+
+    Returns the cleaned pages and the number of removed lines.
+    """
+    page_counts = Counter()
+    for lines in pages:
+        page_counts.update(set(line_signature(line) for line in lines))
+    threshold = max(3, BOILERPLATE_PAGE_SHARE * len(pages))
+    boilerplate = {
+        signature for signature, count in page_counts.items()
+        if count >= threshold and len(signature) >= BOILERPLATE_MIN_CHARS
+    }
+
+    cleaned_pages = []
+    removed = 0
+    for lines in pages:
+        page_references = sum(1 for line in lines if PAGE_REFERENCE_PATTERN.search(line))
+        toc_page = page_references >= max(5, TOC_PAGE_SHARE * len(lines))
+        kept = [
+            line for line in lines
+            if line_signature(line) not in boilerplate
+            and not PAGE_NUMBER_PATTERN.match(line)
+            and not TOC_ENTRY_PATTERN.search(line)
+            and not (toc_page and PAGE_REFERENCE_PATTERN.search(line))
+        ]
+        removed += len(lines) - len(kept)
+        cleaned_pages.append(kept)
+    return cleaned_pages, removed
+
+
+# Helper function to group the lines of a document into sections of flowing text
+def build_sections(pages):
+    """
+    Takes the cleaned pages as input.
+
+    Joins hyphenated and wrapped lines and starts a new section at every heading.
+
+    Returns a list of (section title, text) tuples.
+    """
+    sections = []
+    title = "Einleitung"
+    text = ""
+    for lines in pages:
+        for line in lines:
+            if is_heading(line):
+                if text.strip():
+                    sections.append((title, text.strip()))
+                title = line
+                text = ""
+            elif text.endswith('-') and line[:1].islower():
+                # Word hyphenated at the line break
+                text = text[:-1] + line
+            else:
+                text = f"{text} {line}" if text else line
+    if text.strip():
+        sections.append((title, text.strip()))
+    return sections
+
+
+# Helper function to drop sentences that already appeared in the document
+def drop_repeated_sentences(text, seen_sentences):
+    """
+    Takes the text of a section and the set of sentences seen so far in the document as input.
+
+    Returns the text without long sentences that were already seen, and the number of dropped sentences.
+    """
+    kept = []
+    dropped = 0
+    for sentence in SENTENCE_END_PATTERN.split(text):
+        if len(sentence) >= REPEATED_SENTENCE_MIN_CHARS:
+            signature = re.sub(r'\W+', '', sentence.lower())
+            if signature in seen_sentences:
+                dropped += 1
+                continue
+            seen_sentences.add(signature)
+        kept.append(sentence)
+    return " ".join(kept), dropped
+
+
+# Helper function to split a section into chunks
+def chunk_text(text, chunk_chars=CHUNK_CHARS):
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_END_PATTERN.split(text):
+        if current and len(current) + len(sentence) > chunk_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# Main function to preprocess a single PDF, runs in a worker process
+def preprocess_pdf(pdf_path, output_directory):
+    """
+    Takes the path of a PDF and the output directory as input.
+
+    Writes the normalized, chunked Markdown corpus of the document.
+
+    Returns statistics about the preprocessing.
+    """
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    name = source_name(stem)
+    reader = PdfReader(pdf_path)
+    pages = []
+    raw_chars = 0
+    for page in reader.pages:
+        page_text = page.extract_text() or ""
+        raw_chars += len(page_text)
+        pages.append([re.sub(r'\s+', ' ', line).strip() for line in page_text.splitlines() if line.strip()])
+
+    pages, removed_lines = strip_boilerplate(pages)
+
+    seen = set()
+    seen_sentences = set()
+    duplicate_chunks = 0
+    repeated_sentences = 0
+    blocks = [f"# {name}\n"]
+    for title, section_text in build_sections(pages):
+        section_text, dropped = drop_repeated_sentences(section_text, seen_sentences)
+        repeated_sentences += dropped
+        chunks = []
+        for chunk in chunk_text(section_text):
+            digest = hashlib.sha1(re.sub(r'\W+', '', chunk.lower()).encode("utf-8")).hexdigest()
+            if digest in seen:
+                duplicate_chunks += 1
+                continue
+            seen.add(digest)
+            chunks.append(chunk)
+        # file_search cuts the upload into its own chunks, so every chunk carries its source
+        blocks.extend(f"[{name} – {title}] {chunk}\n" for chunk in chunks)
+
+    output_path = os.path.join(output_directory, f"{stem}.md")
+    corpus = "\n".join(blocks)
+    with open(output_path, "w", encoding="utf-8") as output_file:
+        output_file.write(corpus)
+
+    return {
+        "source": name,
+        "file": os.path.basename(output_path),
+        "pages": len(reader.pages),
+        "pdf_bytes": os.path.getsize(pdf_path),
+        "raw_chars": raw_chars,
+        "corpus_chars": len(corpus),
+        "chunks": len(seen),
+        "sha256": hashlib.sha256(corpus.encode("utf-8")).hexdigest(),
+        "removed_lines": removed_lines,
+        "repeated_sentences": repeated_sentences,
+        "duplicate_chunks": duplicate_chunks,
+    }
+
+
+# Main function to preprocess all PDFs in parallel
+def preprocess_corpus(input_directory=INPUT_DIRECTORY, output_directory=CORPUS_DIRECTORY, workers=None):
+    """
+    Takes the input and output directories and the number of worker processes as input.
+
+    Preprocesses all PDFs across a process pool and writes a manifest with the statistics.
+
+    Returns the list of statistics per document.
+    """
+    pdf_paths = sorted(
+        os.path.join(input_directory, filename) for filename in os.listdir(input_directory) if filename.endswith('.pdf')
+    )
+    if not pdf_paths:
+        raise FileNotFoundError(f"No PDF files found in directory {input_directory}")
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        stats = list(executor.map(preprocess_pdf, pdf_paths, [output_directory] * len(pdf_paths)))
+
+    with open(os.path.join(output_directory, "manifest.json"), "w", encoding="utf-8") as manifest_file:
+        json.dump(stats, manifest_file, ensure_ascii=False, indent=2)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess the party program PDFs into a normalized corpus.")
+    parser.add_argument("--input", default=INPUT_DIRECTORY, help="Directory containing the PDFs")
+    parser.add_argument("--output", default=CORPUS_DIRECTORY, help="Directory for the normalized corpus")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    results = preprocess_corpus(args.input, args.output, args.workers)
+    for result in results:
+        print(f"{result['file']}: {result['pages']} pages, {result['raw_chars']} -> {result['corpus_chars']} chars, "
+              f"{result['chunks']} chunks, {result['removed_lines']} boilerplate lines, "
+              f"{result['repeated_sentences']} repeated sentences, {result['duplicate_chunks']} duplicates")
+    print(f"Total: {sum(r['raw_chars'] for r in results)} extracted chars -> {sum(r['corpus_chars'] for r in results)} corpus chars")
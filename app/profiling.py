@@ -0,0 +1,135 @@
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from uuid import uuid4
+from fastapi import Request
+
+from .dependencies import is_admin_token
+
+logger = logging.getLogger("machma_logger")
+
+# pyinstrument is optional; without it only the phase timings are recorded
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+# Share of requests that are profiled without being asked for
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+# Number of profiles kept in memory
+PROFILE_HISTORY = int(os.getenv("PROFILE_HISTORY", 50))
+# Requests carrying this header with the admin token are always profiled
+PROFILE_HEADER = "X-Profile"
+
+# Profiles of the last requests, newest last
+profiles = deque(maxlen=PROFILE_HISTORY)
+# Profile of the request being handled, None if the request is not profiled
+current_profile = ContextVar("current_profile", default=None)
+
+# Helper function to add time to a phase of the current profile
+def record_phase(name, seconds):
+    profile = current_profile.get()
+    if profile is not None:
+        profile["phases"][name] = round(profile["phases"].get(name, 0) + seconds, 4)
+
+# Helper function to time a phase of the current request
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+# Helper function to attach the session ID to the current profile
+def set_profile_session(session_id):
+    profile = current_profile.get()
+    if profile is not None:
+        profile["session_id"] = session_id
+
+# Helper function to start the profile of a background job submitted by the current request
+def start_job_profile(job_id, session_id):
+    """
+    Takes the job ID and session ID as input.
+
+    If the current request is profiled, creates a profile for the job and links the two,
+    since the job outlives the request that submitted it.
+
+    Returns the job profile, or None if the current request is not profiled.
+    """
+    request_profile = current_profile.get()
+    if request_profile is None:
+        return None
+    profile = {
+        "id": str(uuid4()),
+        "method": "JOB",
+        "path": request_profile["path"],
+        "session_id": session_id,
+        "job_id": job_id,
+        "parent_id": request_profile["id"],
+        "status_code": None,
+        "started_at": time.time(),
+        "duration": None,
+        "phases": {},
+        "profile": None,
+    }
+    request_profile["job_profile_id"] = profile["id"]
+    return profile
+
+# Helper function to store a finished job profile
+def finish_job_profile(profile, status_code, duration):
+    profile["status_code"] = status_code
+    profile["duration"] = round(duration, 4)
+    profiles.append(profile)
+    logger.info(f"Profiled job {profile['job_id']} in {profile['duration']}s: {profile['phases']}")
+
+# Helper function to decide whether a request is profiled
+def should_profile(request: Request):
+    if PROFILE_HEADER.lower() in request.headers:
+        return is_admin_token(request.headers[PROFILE_HEADER])
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+# Middleware to profile requests on demand
+async def profile_request(request: Request, call_next):
+    """
+    Profiles the request if it carries the X-Profile header with the admin token, or is sampled.
+
+    Records the wall-clock duration, the phase timings and, if pyinstrument is installed,
+    an async-aware profile, and keeps the last PROFILE_HISTORY profiles in memory.
+    """
+    if not should_profile(request):
+        return await call_next(request)
+
+    # The dictionary is shared with the handler, which runs in a copy of this context
+    profile = {
+        "id": str(uuid4()),
+        "method": request.method,
+        "path": request.url.path,
+        "session_id": request.query_params.get("session_id"),
+        "status_code": None,
+        "started_at": time.time(),
+        "duration": None,
+        "phases": {},
+        "profile": None,
+    }
+    token = current_profile.set(profile)
+    profiler = Profiler(async_mode="enabled") if Profiler else None
+    started = time.perf_counter()
+    if profiler:
+        profiler.start()
+    try:
+        response = await call_next(request)
+        profile["status_code"] = response.status_code
+        return response
+    finally:
+        if profiler:
+            profiler.stop()
+            profile["profile"] = profiler.output_text(unicode=False, color=False)
+        profile["duration"] = round(time.perf_counter() - started, 4)
+        current_profile.reset(token)
+        profiles.append(profile)
+        logger.info(f"Profiled {profile['method']} {profile['path']} in {profile['duration']}s: {profile['phases']}")
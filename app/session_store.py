@@ -0,0 +1,91 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger("machma_logger")
+
+# The snapshot path may point to a shared volume (e.g. a Cloud Storage bucket mounted into Cloud Run)
+SNAPSHOT_PATH = os.getenv("SESSION_SNAPSHOT_PATH", "snapshots/sessions.json.gz")
+# Sessions that have been inactive for longer than this are not written to the snapshot
+SNAPSHOT_TTL_SECONDS = int(os.getenv("SESSION_SNAPSHOT_TTL_SECONDS", 24 * 60 * 60))
+
+# Helper function to read a snapshot file
+def load_snapshot(path=SNAPSHOT_PATH):
+    """
+    Takes the path of a session snapshot as input.
+
+    Reads the gzip compressed snapshot written by save_snapshot.
+
+    Returns a dictionary of session ID to session data, empty if there is no readable snapshot.
+    """
+    if not os.path.exists(path):
+        logger.info(f"No session snapshot found at {path}")
+        return {}
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        logger.info(f"Loaded {len(snapshot)} sessions from snapshot {path}")
+        return snapshot
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load session snapshot {path}: {e}")
+        return {}
+
+# Helper function to get the modification time of a snapshot file, None if there is none
+def snapshot_mtime(path=SNAPSHOT_PATH):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+# Helper function to merge sessions, keeping the more recently active version of each
+def merge_sessions(snapshot, sessions):
+    """
+    Takes two dictionaries of session ID to session data as input.
+
+    Returns a new dictionary with all sessions; for sessions in both, the one with the later `last_active` wins.
+    """
+    merged = dict(snapshot)
+    for session_id, session_data in sessions.items():
+        existing = merged.get(session_id)
+        if existing is None or session_data.get("last_active", 0) >= existing.get("last_active", 0):
+            merged[session_id] = session_data
+    return merged
+
+# Helper function to write a snapshot file
+def save_snapshot(sessions, path=SNAPSHOT_PATH):
+    """
+    Takes a dictionary of session ID to session data and the snapshot path as input.
+
+    Merges the sessions into the existing snapshot, keeping the more recently active version of
+    each session, so that instances sharing the snapshot do not overwrite newer conversations
+    with stale copies. Drops expired sessions and writes the result atomically.
+
+    Returns the number of sessions written.
+    """
+    snapshot = merge_sessions(load_snapshot(path), sessions)
+    cutoff = time.time() - SNAPSHOT_TTL_SECONDS
+    snapshot = {
+        session_id: session_data for session_id, session_data in snapshot.items()
+        if session_data.get("last_active", 0) >= cutoff
+    }
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temp_path = None
+    try:
+        # Unique temporary file, instances sharing the volume usually all run as PID 1
+        temp_descriptor, temp_path = tempfile.mkstemp(dir=directory or ".", suffix=".tmp")
+        with os.fdopen(temp_descriptor, "wb") as raw_file, gzip.GzipFile(fileobj=raw_file, mode="wb") as snapshot_file:
+            snapshot_file.write(json.dumps(snapshot, separators=(",", ":")).encode("utf-8"))
+        os.replace(temp_path, path)
+        logger.info(f"Saved {len(snapshot)} sessions to snapshot {path}")
+        return len(snapshot)
+    except OSError as e:
+        logger.error(f"Failed to save session snapshot {path}: {e}")
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return 0
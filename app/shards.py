@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import time
+from openai import OpenAI
+from dotenv import load_dotenv
+
+logger = logging.getLogger("machma_logger")
+
+# Load the .env file
+load_dotenv()
+
+# How long a shard is drained after a rate limit error without a Retry-After header
+DEFAULT_THROTTLE_SECONDS = float(os.getenv("SHARD_THROTTLE_SECONDS", 30))
+
+
+class Shard:
+    """
+    One OpenAI API key or project with its own client, assistants and vector store.
+
+    Threads only exist within the project that created them, so a session stays on its shard.
+    A shard that hits a rate limit is drained for a while: no new sessions are routed to it.
+    """
+
+    def __init__(self, api_key):
+        # Stable ID derived from the key, so snapshots stay valid when the key order changes
+        self.id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+        self.client = OpenAI(api_key=api_key)
+        # Assistant, thread and vector store IDs of this shard, filled in on startup
+        self.assistant_dict = {}
+        self.throttled_until = 0.0
+        self.throttle_count = 0
+
+    def healthy(self):
+        return time.time() >= self.throttled_until
+
+    def mark_throttled(self, seconds=None):
+        seconds = seconds or DEFAULT_THROTTLE_SECONDS
+        self.throttled_until = max(self.throttled_until, time.time() + seconds)
+        self.throttle_count += 1
+        logger.info(f"Shard {self.id} throttled, draining for {seconds}s")
+
+    def throttled_for(self):
+        return max(self.throttled_until - time.time(), 0.0)
+
+    def stats(self):
+        return {
+            "id": self.id,
+            "healthy": self.healthy(),
+            "throttled_for_seconds": round(self.throttled_for(), 1),
+            "throttle_count": self.throttle_count,
+        }
+
+
+# Comma separated list of API keys, falls back to the single OPENAI_API_KEY
+api_keys = [key.strip() for key in os.getenv("OPENAI_API_KEYS", os.getenv("OPENAI_API_KEY", "")).split(",") if key.strip()]
+shards = [Shard(api_key) for api_key in api_keys] if api_keys else [Shard(os.getenv("OPENAI_API_KEY", ""))]
+
+# Helper function to route a session to a shard
+def select_shard(session_id):
+    """
+    Takes a session ID as input.
+
+    Picks a shard by rendezvous hashing, so the choice is stable for the session and adding or removing
+    keys only moves the sessions of that key. Throttled shards are skipped unless all of them are throttled.
+
+    Returns the selected shard.
+    """
+    candidates = [shard for shard in shards if shard.healthy()] or shards
+    return max(candidates, key=lambda shard: hashlib.sha256(f"{shard.id}:{session_id}".encode("utf-8")).digest())
+
+# Helper function to get a shard by ID
+def get_shard(shard_id):
+    return next((shard for shard in shards if shard.id == shard_id), None)
+
+# Helper function to record a rate limit error for the shard of a client
+def report_throttled(client, retry_after=None):
+    """
+    Takes the OpenAI client and the Retry-After of the rate limit error in seconds, if any, as input.
+
+    Drains the shard of the client.
+
+    Returns the remaining throttle time of the shard in seconds.
+    """
+    shard = next((shard for shard in shards if shard.client is client), None)
+    if shard is None:
+        return retry_after or DEFAULT_THROTTLE_SECONDS
+    shard.mark_throttled(retry_after)
+    return shard.throttled_for()
+
+# Helper function to drop shards whose setup failed
+def remove_shards(failed_shards):
+    """
+    Takes the shards whose setup failed as input.
+
+    Removes them from the routing, so no sessions are sent to a revoked or misconfigured key.
+    Raises a RuntimeError if no shard is left.
+    """
+    for shard in failed_shards:
+        shards.remove(shard)
+    if not shards:
+        raise RuntimeError("The setup of every API key failed")
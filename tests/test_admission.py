@@ -0,0 +1,56 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app.admission import AdmissionController
+
+
+def test_check_admits_while_slots_are_free():
+    controller = AdmissionController(max_in_flight=2, max_queue=0, max_wait_seconds=30)
+    controller.check()
+    assert controller.estimated_wait() == 0.0
+
+
+def test_rejects_when_queue_is_full():
+    controller = AdmissionController(max_in_flight=1, max_queue=0, max_wait_seconds=30, initial_run_seconds=12.5)
+
+    async def run():
+        async with controller.slot():
+            with pytest.raises(HTTPException) as rejected:
+                controller.check()
+            return rejected.value
+
+    rejected = asyncio.run(run())
+    assert rejected.status_code == 503
+    assert rejected.headers["Retry-After"] == "13"
+    assert controller.in_flight == 0
+
+
+def test_rejects_when_estimated_wait_is_too_long():
+    controller = AdmissionController(max_in_flight=1, max_queue=10, max_wait_seconds=5, initial_run_seconds=10)
+
+    async def run():
+        async with controller.slot():
+            with pytest.raises(HTTPException) as rejected:
+                async with controller.slot():
+                    pass
+            return rejected.value
+
+    assert asyncio.run(run()).status_code == 503
+    assert controller.waiting == 0
+
+
+def test_queued_run_waits_for_slot():
+    controller = AdmissionController(max_in_flight=1, max_queue=1, max_wait_seconds=30, initial_run_seconds=1)
+    order = []
+
+    async def run(name):
+        async with controller.slot():
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(run("first"), run("second"))
+
+    asyncio.run(main())
+    assert order == ["first", "second"]
+    assert controller.stats()["in_flight"] == 0
@@ -0,0 +1,95 @@
+import asyncio
+import time
+import pytest
+from fastapi import HTTPException
+from app import jobs, main
+from app.openai_assistant import new_context_state
+
+
+@pytest.fixture(autouse=True)
+def job_store(monkeypatch):
+    job_store = {}
+    monkeypatch.setattr(jobs, "jobs", job_store)
+    monkeypatch.setattr(main, "jobs", job_store)
+    return job_store
+
+
+@pytest.fixture
+def openings(monkeypatch):
+    calls = []
+
+    async def open_conversation(session_data, shard):
+        calls.append(session_data)
+        if len(calls) <= openings_failing["count"]:
+            raise HTTPException(status_code=500, detail="Opening failed")
+        session_data["thread_id"] = "thread"
+        session_data["chat_history"]["bot"].append("Willkommen")
+        session_data["timestamps"]["bot"].append(time.time())
+        return session_data["chat_history"]
+
+    async def chatbot_completion(client, user_message, *args, **kwargs):
+        return f"Antwort auf {user_message}"
+
+    openings_failing = {"count": 0}
+    monkeypatch.setattr(main.shards[0], "assistant_dict", {"casual_assistant": "casual", "political_assistant": "political"})
+    monkeypatch.setattr(main, "open_conversation", open_conversation)
+    monkeypatch.setattr(main, "chatbot_completion", chatbot_completion)
+    return calls, openings_failing
+
+
+def new_session():
+    return {
+        "chat_history": {"user": [], "bot": []},
+        "timestamps": {"user": [], "bot": []},
+        "treatment": False,
+        "thread_id": None,
+        "shard": main.shards[0].id,
+        "context": new_context_state(),
+    }
+
+
+def failed_opening(session_data):
+    async def fail():
+        raise HTTPException(status_code=500, detail="Opening failed")
+
+    async def submit():
+        job = jobs.submit_job("session", fail(), kind="opening")
+        await job["task"]
+        return job
+
+    job = asyncio.run(submit())
+    session_data["opening_job"] = job["id"]
+    return job
+
+
+def test_turn_restarts_failed_opening(openings):
+    calls, _ = openings
+    session_data = new_session()
+    failed_opening(session_data)
+    chat_history = asyncio.run(main.run_chat_turn("session", session_data, "Hallo"))
+    assert len(calls) == 1
+    assert chat_history == {"user": ["Hallo"], "bot": ["Willkommen", "Antwort auf Hallo"]}
+
+
+def test_turn_restarts_expired_opening(openings):
+    calls, _ = openings
+    session_data = new_session()
+    session_data["opening_job"] = "expired"
+    asyncio.run(main.run_chat_turn("session", session_data, "Hallo"))
+    assert len(calls) == 1
+    assert session_data["thread_id"] == "thread"
+
+
+def test_turn_fails_when_restarted_opening_fails(openings):
+    calls, openings_failing = openings
+    openings_failing["count"] = 1
+    session_data = new_session()
+    failed_opening(session_data)
+    with pytest.raises(HTTPException) as failed:
+        asyncio.run(main.run_chat_turn("session", session_data, "Hallo"))
+    assert failed.value.status_code == 500
+    assert session_data["chat_history"]["user"] == []
+
+    # The next turn starts the opening again instead of repeating the stored error
+    asyncio.run(main.run_chat_turn("session", session_data, "Hallo"))
+    assert len(calls) == 2
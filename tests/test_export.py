@@ -0,0 +1,94 @@
+import pytest
+from fastapi.testclient import TestClient
+from app import dependencies, main
+from app.export import decode_cursor, encode_cursor, iter_csv, select_page, session_record
+
+
+def make_sessions(count):
+    return {
+        f"session-{index}": {
+            "created_at": 1000.0 + index // 2,
+            "treatment": index % 2 == 0,
+            "chat_history": {"user": ["Hallo"], "bot": ["Willkommen", "Antwort"]},
+            "timestamps": {"user": [1001.0], "bot": [1000.0, 1002.0]},
+        }
+        for index in range(count)
+    }
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(1234.5, "session-1", "instance")) == (1234.5, "session-1", "instance")
+
+
+def test_cursor_of_another_instance_is_rejected():
+    _, cursor = select_page(make_sessions(4).items(), 2, instance_id="first")
+    assert select_page(make_sessions(4).items(), 2, cursor, instance_id="first")[0]
+    with pytest.raises(ValueError):
+        select_page(make_sessions(4).items(), 2, cursor, instance_id="second")
+
+
+def test_invalid_cursor():
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+
+def test_select_page_returns_every_session_once():
+    sessions = make_sessions(7)
+    exported = []
+    cursor = None
+    while True:
+        records, cursor = select_page(sessions.items(), 3, cursor)
+        exported.extend(record["session_id"] for record in records)
+        if not cursor:
+            break
+    assert sorted(exported) == sorted(sessions)
+    assert len(exported) == len(set(exported))
+
+
+def test_select_page_orders_by_creation_time_and_session_id():
+    records, next_cursor = select_page(make_sessions(4).items(), 10)
+    assert [record["session_id"] for record in records] == ["session-0", "session-1", "session-2", "session-3"]
+    assert next_cursor is None
+
+
+def test_select_page_filters():
+    records, _ = select_page(make_sessions(6).items(), 10, since=1001.0, until=1002.0, treatment=True)
+    assert [record["session_id"] for record in records] == ["session-2"]
+
+
+def test_session_record_interleaves_turns():
+    record = session_record("session-0", make_sessions(1)["session-0"])
+    assert [turn["role"] for turn in record["turns"]] == ["bot", "user", "bot"]
+
+
+def test_iter_csv_writes_sessions_without_turns():
+    records = [session_record("empty", {"created_at": 1000.0, "treatment": False})]
+    lines = "".join(iter_csv(records)).splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith("empty,")
+
+
+def test_export_endpoint_pages_live_and_snapshot_sessions(monkeypatch):
+    sessions = make_sessions(5)
+    monkeypatch.setattr(dependencies, "ADMIN_TOKEN", "token")
+    monkeypatch.setattr(main, "sessions", {key: sessions[key] for key in ("session-0", "session-1")})
+    monkeypatch.setattr(main, "restored_sessions", {})
+    monkeypatch.setattr(main, "snapshot_state", {"mtime": None})
+    monkeypatch.setattr(main, "snapshot_mtime", lambda: 1.0)
+    monkeypatch.setattr(main, "load_snapshot", lambda: {key: sessions[key] for key in ("session-2", "session-3", "session-4")})
+
+    client = TestClient(main.app)
+    headers = {"X-Admin-Token": "token"}
+    exported = []
+    params = {"limit": 2}
+    while True:
+        response = client.get("/admin/export", params=params, headers=headers)
+        assert response.status_code == 200
+        exported.extend(line for line in response.text.splitlines())
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert len(exported) == 5
+
+    monkeypatch.setattr(main, "INSTANCE_ID", "another-instance")
+    assert client.get("/admin/export", params=params, headers=headers).status_code == 400
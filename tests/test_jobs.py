@@ -0,0 +1,85 @@
+import asyncio
+import json
+import time
+import pytest
+from app import jobs as jobs_module
+from app import main
+from app.post_data import ChatInput
+from app.jobs import get_pending_job, prune_jobs, submit_job, wait_for_job
+
+
+@pytest.fixture(autouse=True)
+def jobs(monkeypatch):
+    job_store = {}
+    monkeypatch.setattr(jobs_module, "jobs", job_store)
+    return job_store
+
+
+async def answer(event, result="Antwort"):
+    await event.wait()
+    return result
+
+
+def test_pending_job_is_found_until_finished(jobs):
+    async def main():
+        event = asyncio.Event()
+        job = submit_job("session", answer(event), user_input="Hallo")
+        assert get_pending_job("session") is job
+        assert job["user_input"] == "Hallo"
+        assert get_pending_job("session", kind="opening") is None
+        assert get_pending_job("other") is None
+        event.set()
+        await job["task"]
+        assert job["status"] == "completed" and job["result"] == "Antwort"
+        assert get_pending_job("session") is None
+
+    asyncio.run(main())
+
+
+def test_prune_jobs_drops_expired_finished_jobs(jobs, monkeypatch):
+    monkeypatch.setattr(jobs_module, "JOB_RETENTION_SECONDS", 60)
+    now = time.time()
+    jobs["expired"] = {"finished_at": now - 120}
+    jobs["recent"] = {"finished_at": now - 10}
+    jobs["pending"] = {"finished_at": None}
+    prune_jobs()
+    assert set(jobs) == {"recent", "pending"}
+
+
+def test_wait_for_job_is_capped(monkeypatch):
+    monkeypatch.setattr(jobs_module, "MAX_POLL_SECONDS", 0.05)
+
+    async def main():
+        event = asyncio.Event()
+        job = submit_job("session", answer(event))
+        started = time.monotonic()
+        assert (await wait_for_job(job, timeout=30))["status"] == "pending"
+        assert time.monotonic() - started < 1
+        event.set()
+        assert (await wait_for_job(job, timeout=30))["status"] == "completed"
+
+    asyncio.run(main())
+
+
+def test_post_chat_reuses_or_rejects_a_pending_turn(monkeypatch):
+    async def never_answered(session_id, session_data, user_input):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(main, "sessions", {"session": {"last_active": time.time()}})
+    monkeypatch.setattr(main, "run_chat_turn", never_answered)
+
+    async def post(user_input):
+        response = await main.post_chat(ChatInput(user_input=user_input, session_id="session", async_job=True))
+        return response.status_code, json.loads(response.body)
+
+    async def run():
+        status, first = await post("Hallo")
+        assert status == 202
+        await asyncio.sleep(0)
+        assert await post("Hallo") == (202, first)
+        status, rejected = await post("Etwas anderes")
+        assert status == 409
+        assert rejected["job_id"] == first["job_id"]
+        get_pending_job("session")["task"].cancel()
+
+    asyncio.run(run())
@@ -0,0 +1,162 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from fastapi import HTTPException
+from app.openai_assistant import (
+    CONTEXT_SETTINGS,
+    chatbot_completion,
+    get_political_background,
+    new_context_state,
+    update_rolling_summary,
+)
+
+# chatbot_completion without its backoff, so a failed attempt can be inspected and retried by the test
+run_turn = chatbot_completion.__wrapped__
+
+
+def text_message(index, role, text, run_id=None):
+    return SimpleNamespace(
+        id=f"msg-{index}", role=role, run_id=run_id, content=[SimpleNamespace(text=SimpleNamespace(value=text))],
+    )
+
+
+class FakePage:
+    def __init__(self, data):
+        self.data = data
+
+    def __iter__(self):
+        return iter(self.data)
+
+
+class FakeClient:
+    """
+    Stands in for the OpenAI client of a shard with a single thread.
+    """
+
+    def __init__(self, starter="Starter"):
+        self.messages = [text_message(0, "user", starter), text_message(1, "assistant", "Opening")]
+        self.created = []
+        self.runs = []
+        self.summary_requests = []
+        self.fail_runs = 0
+        self.fail_summary = False
+        self.beta = SimpleNamespace(threads=SimpleNamespace(
+            messages=SimpleNamespace(create=self.create_message, list=self.list_messages),
+            runs=SimpleNamespace(create_and_poll=self.create_and_poll),
+        ))
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.summarize))
+
+    def create_message(self, thread_id, role, content):
+        message = text_message(len(self.messages), role, content)
+        self.messages.append(message)
+        self.created.append(content)
+        return message
+
+    def list_messages(self, thread_id, order="desc", run_id=None, limit=None):
+        messages = [message for message in self.messages if run_id is None or message.run_id == run_id]
+        if order == "desc":
+            messages = messages[::-1]
+        return FakePage(messages[:limit] if limit else messages)
+
+    def create_and_poll(self, thread_id, assistant_id, **options):
+        self.runs.append(options)
+        if self.fail_runs:
+            self.fail_runs -= 1
+            raise RuntimeError("Run failed")
+        run_id = f"run-{len(self.runs)}"
+        self.messages.append(text_message(len(self.messages), "assistant", f"Answer {len(self.runs)}", run_id))
+        usage = SimpleNamespace(prompt_tokens=100, completion_tokens=10)
+        return SimpleNamespace(id=run_id, status="completed", usage=usage, incomplete_details=None, last_error=None)
+
+    def summarize(self, model, messages):
+        if self.fail_summary:
+            raise RuntimeError("Summary failed")
+        self.summary_requests.append(messages[1]["content"])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"Summary {len(self.summary_requests)}"))])
+
+
+def run_turns(client, context_state, count):
+    return [
+        asyncio.run(run_turn(client, f"Question {index}", "assistant", "thread", "casual", context_state))
+        for index in range(count)
+    ]
+
+
+def test_metrics_follow_thread_size():
+    client = FakeClient()
+    context_state = new_context_state()
+    last_messages = CONTEXT_SETTINGS["casual"]["last_messages"]
+    assert run_turns(client, context_state, 6) == [f"Answer {index}" for index in range(1, 7)]
+    metrics = context_state["metrics"]
+    assert metrics["thread_messages"] == len(client.messages) == 14
+    assert metrics["truncated_messages"] == 13 - last_messages
+    assert metrics["turns"] == 6
+    assert metrics["prompt_tokens"] == 600
+
+
+def test_retried_turn_does_not_post_message_again():
+    client = FakeClient()
+    context_state = new_context_state()
+    client.fail_runs = 1
+    with pytest.raises(HTTPException):
+        asyncio.run(run_turn(client, "Hallo", "assistant", "thread", "casual", context_state))
+    assert context_state["pending_message"]["text"] == "Hallo"
+    assert asyncio.run(run_turn(client, "Hallo", "assistant", "thread", "casual", context_state)) == "Answer 2"
+    assert client.created == ["Hallo"]
+    assert context_state["pending_message"] is None
+    assert context_state["metrics"]["thread_messages"] == 4
+
+
+def test_pinned_background_and_summary_once_truncated():
+    client = FakeClient(starter="Be friendly and introduce yourself.")
+    background = get_political_background("weiblich", 1980, "Abitur", "Studium", "hoch", "Klimaschutz")
+    context_state = new_context_state(background)
+    run_turns(client, context_state, 6)
+    assert "additional_instructions" not in client.runs[0]
+    instructions = client.runs[-1]["additional_instructions"]
+    assert "Klimaschutz" in instructions
+    assert "Do not introduce yourself again" in instructions
+    assert "Be friendly and introduce yourself." not in instructions
+    assert context_state["summary"] in instructions
+
+
+def test_rolling_summary_window():
+    client = FakeClient()
+    for index in range(2, 20):
+        client.messages.append(text_message(index, "user" if index % 2 else "assistant", f"Message {index}"))
+    context_state = new_context_state()
+    context_state["metrics"]["thread_messages"] = 20
+
+    # Messages 1 to 9 dropped out of the last 10; the batch runs 5 messages ahead into the window
+    assert asyncio.run(update_rolling_summary(client, "thread", context_state, 10)) == "Summary 1"
+    assert context_state["summarized_messages"] == 15
+    transcript = client.summary_requests[0]
+    assert "Opening" in transcript and "Message 14" in transcript
+    assert "Starter" not in transcript and "Message 15" not in transcript
+
+    # No new summary until messages beyond the summarized ones drop out of the window
+    context_state["metrics"]["thread_messages"] = 24
+    asyncio.run(update_rolling_summary(client, "thread", context_state, 10))
+    assert len(client.summary_requests) == 1
+    context_state["metrics"]["thread_messages"] = 26
+    asyncio.run(update_rolling_summary(client, "thread", context_state, 10))
+    assert len(client.summary_requests) == 2
+    assert context_state["summarized_messages"] == 21
+
+
+def test_rolling_summary_never_includes_current_message():
+    client = FakeClient()
+    context_state = new_context_state()
+    context_state["metrics"]["thread_messages"] = 4
+    asyncio.run(update_rolling_summary(client, "thread", context_state, 1))
+    assert context_state["summarized_messages"] == 3
+
+
+def test_failed_summary_keeps_previous_summary():
+    client = FakeClient()
+    context_state = new_context_state()
+    context_state["summary"] = "Previous"
+    context_state["metrics"]["thread_messages"] = 20
+    client.fail_summary = True
+    assert asyncio.run(update_rolling_summary(client, "thread", context_state, 10)) == "Previous"
+    assert context_state["summarized_messages"] == 1
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("pypdf")
+from app import preprocess_corpus
+from app.preprocess_corpus import chunk_text, is_heading, strip_boilerplate
+
+
+def test_chunk_text_splits_at_sentence_boundaries():
+    sentences = [f"Satz Nummer {index} über Europa." for index in range(40)]
+    chunks = chunk_text(" ".join(sentences), chunk_chars=200)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert all(chunk.endswith(".") for chunk in chunks)
+    assert " ".join(chunks) == " ".join(sentences)
+
+
+def test_chunk_text_keeps_long_sentence_whole():
+    sentence = "Ein sehr langer Satz " * 20
+    assert chunk_text(sentence.strip(), chunk_chars=50) == [sentence.strip()]
+
+
+def test_strip_boilerplate_removes_running_headers_and_page_numbers():
+    texts = [f"Europa braucht {word} Politik." for word in "eine neue bessere soziale grüne mutige klare faire offene starke".split()]
+    pages = [["Wahlprogramm zur Europawahl 2024", text, str(index)] for index, text in enumerate(texts, start=1)]
+    cleaned, removed = strip_boilerplate(pages)
+    assert cleaned == [[text] for text in texts]
+    assert removed == 20
+
+
+def test_strip_boilerplate_keeps_short_repeated_lines():
+    pages = [["Europa", f"Text {index}"] for index in range(10)]
+    cleaned, removed = strip_boilerplate(pages)
+    assert removed == 0
+
+
+def test_strip_boilerplate_removes_table_of_contents():
+    pages = [["Präambel .......... 1", "1. Frieden sichern ..... 3"], ["Europa ist ein Projekt des Friedens."]]
+    cleaned, _ = strip_boilerplate(pages)
+    assert cleaned == [[], ["Europa ist ein Projekt des Friedens."]]
+
+
+@pytest.mark.parametrize("line", ["1. Europa verteidigen", "Kapitel 2: Klima", "FÜR EIN SOZIALES EUROPA"])
+def test_is_heading(line):
+    assert is_heading(line)
+
+
+@pytest.mark.parametrize("line", ["IPCC", "ÖPNV", "ACER10", "Wir wollen ein starkes Europa."])
+def test_is_not_heading(line):
+    assert not is_heading(line)
+
+
+def test_preprocess_pdf_tags_every_chunk(tmp_path, monkeypatch):
+    sentences = " ".join(f"Wir fordern Maßnahme Nummer {index} für Europa." for index in range(80))
+    pages = [SimpleNamespace(extract_text=lambda: f"1. Soziales Europa\n{sentences}")]
+    monkeypatch.setattr(preprocess_corpus, "PdfReader", lambda path: SimpleNamespace(pages=pages))
+    pdf_path = tmp_path / "SPD.pdf"
+    pdf_path.write_bytes(b"%PDF")
+
+    stats = preprocess_corpus.preprocess_pdf(str(pdf_path), str(tmp_path))
+    chunks = (tmp_path / "SPD.md").read_text(encoding="utf-8").split("\n\n")[1:]
+    assert stats["chunks"] == len(chunks) > 1
+    assert all(chunk.startswith("[SPD – 1. Soziales Europa] ") for chunk in chunks)
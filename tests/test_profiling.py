@@ -0,0 +1,92 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from app import dependencies, jobs, main, profiling
+from app.profiling import current_profile, phase, record_phase
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(dependencies, "ADMIN_TOKEN", "token")
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0)
+    monkeypatch.setattr(profiling, "profiles", profiling.profiles.__class__(maxlen=10))
+    job_store = {}
+    monkeypatch.setattr(jobs, "jobs", job_store)
+    monkeypatch.setattr(main, "jobs", job_store)
+    return TestClient(main.app)
+
+
+def test_phases_are_only_recorded_for_profiled_requests():
+    record_phase("unprofiled", 1.0)
+    profile = {"phases": {}}
+    token = current_profile.set(profile)
+    try:
+        with phase("upstream_run"):
+            pass
+        record_phase("upstream_run", 0.5)
+    finally:
+        current_profile.reset(token)
+    assert list(profile["phases"]) == ["upstream_run"]
+    assert profile["phases"]["upstream_run"] >= 0.5
+
+
+def test_request_is_profiled_only_with_admin_token(client):
+    client.get("/chat/jobs/missing", headers={"X-Profile": "wrong"})
+    assert len(profiling.profiles) == 0
+    response = client.get("/chat/jobs/missing", headers={"X-Profile": "token"})
+    assert response.status_code == 404
+    profile = profiling.profiles[-1]
+    assert profile["path"] == "/chat/jobs/missing"
+    assert profile["status_code"] == 404
+    assert profile["duration"] is not None
+
+
+def test_job_result_serialization_is_profiled(client):
+    async def finished_job():
+        job = jobs.submit_job("session", asyncio.sleep(0, result={"user": [], "bot": ["Hallo"]}))
+        await job["task"]
+        return job
+
+    job = asyncio.run(finished_job())
+    response = client.get(f"/chat/jobs/{job['id']}", headers={"X-Profile": "token"})
+    assert response.json()["chat_history"] == {"user": [], "bot": ["Hallo"]}
+    profile = profiling.profiles[-1]
+    assert profile["session_id"] == "session"
+    assert "serialize_response" in profile["phases"]
+
+
+def test_job_profile_is_linked_to_request_profile(monkeypatch):
+    monkeypatch.setattr(profiling, "profiles", profiling.profiles.__class__(maxlen=10))
+    monkeypatch.setattr(jobs, "jobs", {})
+
+    async def work():
+        record_phase("upstream_run", 0.25)
+        return "Antwort"
+
+    async def submit():
+        request_profile = {"id": "request", "path": "/chat", "phases": {}}
+        current_profile.set(request_profile)
+        job = jobs.submit_job("session", work())
+        await job["task"]
+        return request_profile, job
+
+    request_profile, job = asyncio.run(submit())
+    job_profile = profiling.profiles[-1]
+    assert request_profile["job_profile_id"] == job_profile["id"]
+    assert job_profile["parent_id"] == "request"
+    assert job_profile["job_id"] == job["id"]
+    assert job_profile["phases"] == {"upstream_run": 0.25}
+    assert request_profile["phases"] == {}
+    assert job_profile["status_code"] == 200
+
+
+def test_job_of_unprofiled_request_is_not_profiled(monkeypatch):
+    monkeypatch.setattr(profiling, "profiles", profiling.profiles.__class__(maxlen=10))
+    monkeypatch.setattr(jobs, "jobs", {})
+
+    async def submit():
+        job = jobs.submit_job("session", asyncio.sleep(0))
+        await job["task"]
+
+    asyncio.run(submit())
+    assert len(profiling.profiles) == 0
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from app import main
+from app.session_store import load_snapshot, merge_sessions, save_snapshot, snapshot_mtime
+
+
+def test_save_and_load_snapshot(tmp_path):
+    path = str(tmp_path / "snapshots" / "sessions.json.gz")
+    sessions = {"a": {"last_active": time.time(), "chat_history": {"user": ["Hallo"], "bot": []}}}
+    assert save_snapshot(sessions, path) == 1
+    assert load_snapshot(path) == sessions
+
+
+def test_load_missing_snapshot(tmp_path):
+    assert load_snapshot(str(tmp_path / "missing.json.gz")) == {}
+
+
+def test_merge_keeps_newer_session():
+    newer = {"last_active": 200.0, "chat_history": "newer"}
+    older = {"last_active": 100.0, "chat_history": "older"}
+    assert merge_sessions({"a": newer}, {"a": older})["a"] is newer
+    assert merge_sessions({"a": older}, {"a": newer})["a"] is newer
+
+
+def test_save_does_not_overwrite_newer_snapshot_session(tmp_path):
+    path = str(tmp_path / "sessions.json.gz")
+    now = time.time()
+    save_snapshot({"a": {"last_active": now, "version": "newer"}, "b": {"last_active": now}}, path)
+    save_snapshot({"a": {"last_active": now - 10, "version": "stale"}}, path)
+    snapshot = load_snapshot(path)
+    assert snapshot["a"]["version"] == "newer"
+    assert "b" in snapshot
+
+
+def test_save_drops_expired_sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.session_store.SNAPSHOT_TTL_SECONDS", 60)
+    path = str(tmp_path / "sessions.json.gz")
+    now = time.time()
+    assert save_snapshot({"active": {"last_active": now}, "expired": {"last_active": now - 120}}, path) == 1
+    assert list(load_snapshot(path)) == ["active"]
+
+
+def test_snapshot_mtime(tmp_path):
+    path = str(tmp_path / "sessions.json.gz")
+    assert snapshot_mtime(path) is None
+    save_snapshot({"a": {"last_active": time.time()}}, path)
+    assert snapshot_mtime(path) is not None
+
+
+def test_get_session_rereads_changed_snapshot_only(monkeypatch):
+
+    reads = []
+    mtime = {"value": 1.0}
+    snapshot = {"restored": {"last_active": time.time(), "chat_history": {"user": [], "bot": []}}}
+    monkeypatch.setattr(main, "snapshot_mtime", lambda: mtime["value"])
+    monkeypatch.setattr(main, "load_snapshot", lambda: reads.append(1) or dict(snapshot))
+    monkeypatch.setattr(main, "sessions", {})
+    monkeypatch.setattr(main, "restored_sessions", {})
+    monkeypatch.setattr(main, "snapshot_state", {"mtime": 1.0})
+
+    assert asyncio.run(main.get_session("restored")) is None
+    assert reads == []
+
+    mtime["value"] = 2.0
+    assert asyncio.run(main.get_session("restored")) is not None
+    assert "restored" in main.sessions and "restored" not in main.restored_sessions
+    assert asyncio.run(main.get_session("unknown")) is None
+    assert reads == [1]
@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+import httpx
+import pytest
+from fastapi import HTTPException
+from openai import RateLimitError
+from app import shards as shards_module
+from app.openai_assistant import create_casual_conversation
+from app.shards import Shard, select_shard
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    test_shards = [Shard(f"test-key-{index}") for index in range(3)]
+    monkeypatch.setattr(shards_module, "shards", test_shards)
+    return test_shards
+
+
+def test_select_shard_is_stable(shards):
+    session_ids = [f"session-{index}" for index in range(50)]
+    first = [select_shard(session_id).id for session_id in session_ids]
+    assert [select_shard(session_id).id for session_id in session_ids] == first
+    assert len(set(first)) == len(shards)
+
+
+def test_removing_a_shard_only_moves_its_sessions(shards, monkeypatch):
+    session_ids = [f"session-{index}" for index in range(50)]
+    before = {session_id: select_shard(session_id) for session_id in session_ids}
+    monkeypatch.setattr(shards_module, "shards", shards[1:])
+    for session_id, shard in before.items():
+        if shard is not shards[0]:
+            assert select_shard(session_id) is shard
+
+
+def test_throttled_shard_is_drained(shards):
+    session_id = next(f"session-{index}" for index in range(100) if select_shard(f"session-{index}") is shards[0])
+    shards[0].mark_throttled(60)
+    assert not shards[0].healthy()
+    assert select_shard(session_id) is not shards[0]
+    assert 0 < shards[0].throttled_for() <= 60
+
+
+def test_all_shards_throttled_falls_back_to_all(shards):
+    for shard in shards:
+        shard.mark_throttled(60)
+    assert select_shard("session") in shards
+
+
+def test_throttled_opening_is_not_retried(shards):
+    calls = []
+
+    def create_thread(**kwargs):
+        calls.append(kwargs)
+        response = httpx.Response(429, headers={"retry-after": "7"}, request=httpx.Request("POST", "https://api.openai.com"))
+        raise RateLimitError("Rate limit reached", response=response, body=None)
+
+    shards[0].client = SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(create=create_thread)))
+    with pytest.raises(HTTPException) as rejected:
+        asyncio.run(create_casual_conversation(shards[0].client, "assistant"))
+    rejected = rejected.value
+    assert rejected.status_code == 503
+    assert rejected.headers["Retry-After"] == "7"
+    assert len(calls) == 1
+    assert shards[0].throttle_count == 1